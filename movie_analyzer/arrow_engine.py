@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+# Engines of Data: 'pandas' parses and joins with pandas, 'arrow' parses the IMDb dumps with the
+# multithreaded pyarrow reader and joins through Arrow hash lookups.
+ENGINES = ['pandas', 'arrow']
+
+# Numbers are parsed at the width of their pandas dtype and converted straight to its masked array,
+# so no column is ever held at a wider type or as float64 with NaN.
+ARROW_TYPES = {
+    'object': pa.string(),
+    'category': pa.dictionary(pa.int32(), pa.string()),
+    'Int8': pa.int8(),
+    'Int32': pa.int32(),
+    'Float64': pa.float64(),
+}
+STRING_TYPES = {pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+IMDB_TYPES = {**STRING_TYPES, pa.int8(): pd.Int8Dtype(), pa.int32(): pd.Int32Dtype(), pa.float64(): pd.Float64Dtype()}
+
+
+def _options(schema, index_col, block_size=None):
+    column_types = {column: pa.string() for column in schema['usecols']}
+    column_types.update({column: ARROW_TYPES[dtype] for column, dtype in schema['dtype'].items()})
+    read_options = pacsv.ReadOptions(use_threads=True, **({'block_size': block_size} if block_size else {}))
+    parse_options = pacsv.ParseOptions(delimiter='\t', quote_char=False, newlines_in_values=False)
+    convert_options = pacsv.ConvertOptions(
+        include_columns=schema['usecols'], column_types=column_types, null_values=['\\N'],
+        strings_can_be_null=True, quoted_strings_can_be_null=False,
+    )
+    return read_options, parse_options, convert_options
+
+
+def to_pandas(table, schema, index_col):
+    # Same columns and dtypes as pd.read_csv with the schema, except that free text columns and the
+    # title ids of the index stay in Arrow memory as string[pyarrow]. Dictionary columns become
+    # categoricals without copying the strings; like those of pd.read_csv, their categories are sorted
+    # and only hold the values present, even in slices of a table that share its dictionary.
+    data = table.to_pandas(types_mapper=IMDB_TYPES.get)
+    for column, dtype in schema['dtype'].items():
+        if dtype == 'category':
+            values = data[column].cat.remove_unused_categories()
+            data[column] = values.cat.reorder_categories(values.cat.categories.sort_values())
+    if index_col is not None:
+        data = data.set_index(index_col)
+    return data
+
+
+def read_parquet(path):
+    # Cached tables of the arrow engine, with the text columns and title ids back in Arrow memory.
+    return pq.read_table(path).to_pandas(types_mapper=STRING_TYPES.get)
+
+
+def read_imdb(path, schema, index_col=None):
+    read_options, parse_options, convert_options = _options(schema, index_col)
+    return to_pandas(pacsv.read_csv(path, read_options, parse_options, convert_options), schema, index_col)
+
+
+def read_imdb_chunks(path, schema, index_col, chunksize):
+    # Chunks of exactly chunksize rows like pd.read_csv, cut from the blocks that the streaming
+    # reader parses in the background.
+    reader = pacsv.open_csv(path, *_options(schema, index_col, block_size=1 << 24))
+    batches, rows = [], 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= chunksize:
+            table = pa.Table.from_batches(batches)
+            end = rows - rows % chunksize
+            for start in range(0, end, chunksize):
+                yield to_pandas(table.slice(start, chunksize), schema, index_col)
+            batches, rows = table.slice(end).to_batches(), rows - end
+    if rows:
+        yield to_pandas(pa.Table.from_batches(batches, schema=reader.schema), schema, index_col)
+
+
+def _arrow_array(values):
+    # The Arrow array behind string[pyarrow] values, without copying them; other values are converted.
+    if isinstance(values.dtype, pd.StringDtype) and values.dtype.storage == 'pyarrow':
+        return pa.array(values.array)
+    return pa.array(np.asarray(values, dtype=object), type=pa.string())
+
+
+def lookup_titles(ids, table_ids):
+    # Row of every id in table_ids, -1 where it is missing, with an Arrow hash lookup.
+    value_set = _arrow_array(table_ids)
+    if isinstance(value_set, pa.ChunkedArray):
+        value_set = value_set.combine_chunks()
+    positions = pc.index_in(_arrow_array(ids), value_set=value_set)
+    return pc.fill_null(positions, -1).to_numpy()
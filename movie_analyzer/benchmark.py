@@ -0,0 +1,305 @@
+import argparse
+import csv
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from arrow_engine import ENGINES
+from data import Data
+from genres import GENRES
+from instrumentation import peak_rss_since_reset_mb, reset_peak_rss
+from report import best_movies_by_region, impact_ranking, polish_movies_by_year
+from sharding import ShardPool
+
+# Bump whenever the generated files change so cached datasets are generated again.
+GENERATOR_VERSION = 2
+
+REGION_WEIGHTS = {
+    'US': 16, 'GB': 7, 'DE': 7, 'FR': 7, 'IT': 5, 'ES': 5, 'JP': 5, 'BR': 4, 'CA': 4, 'IN': 4, 'MX': 3,
+    'PL': 3, 'RU': 3, 'AU': 3, 'SE': 2, 'NL': 2, 'AR': 2, 'PT': 2, 'TR': 2, 'GR': 2, 'FI': 2, 'HU': 2,
+    'DK': 1, 'NO': 1, 'AT': 1, 'CH': 1, 'BE': 1, 'KR': 1, 'CN': 1, 'CZ': 1, 'RO': 1, 'IE': 1, 'XWW': 3,
+}
+TITLE_TYPE_WEIGHTS = {
+    'tvEpisode': 65, 'short': 9, 'movie': 7, 'video': 3, 'tvSeries': 3, 'tvMovie': 2,
+    'tvShort': 1, 'tvMiniSeries': 1, 'tvSpecial': 1, 'videoGame': 1,
+}
+LANGUAGES = ['en', 'fr', 'es', 'de', 'ja', 'it', 'pt', 'ru', 'pl', 'hi']
+WORLD_BANK_YEARS = [str(year) for year in range(1960, 2024)]
+IMDB_HEADERS = {
+    'title.akas': ['titleId', 'ordering', 'title', 'region', 'language', 'types', 'attributes', 'isOriginalTitle'],
+    'title.basics': [
+        'tconst', 'titleType', 'primaryTitle', 'originalTitle', 'isAdult', 'startYear', 'endYear',
+        'runtimeMinutes', 'genres',
+    ],
+    'title.ratings': ['tconst', 'averageRating', 'numVotes'],
+}
+
+
+def _choice(rng, weights, size):
+    values = np.array(list(weights), dtype=object)
+    probabilities = np.array(list(weights.values()), dtype=float)
+    return values[rng.choice(len(values), size=size, p=probabilities / probabilities.sum())]
+
+
+def _with_missing(rng, values, share):
+    values = pd.Series(values, dtype=object)
+    values[rng.random(len(values)) < share] = np.nan
+    return values
+
+
+def _tconst(ids):
+    return 'tt' + pd.Series(ids).astype(str).str.zfill(7)
+
+
+def _write_block(frame, path, first):
+    frame.to_csv(
+        path, sep='\t', index=False, header=first, mode='w' if first else 'a', na_rep='\\N', quoting=csv.QUOTE_NONE,
+    )
+
+
+def _imdb_block(rng, first_id, count, n_titles, genre_combinations):
+    ids = np.arange(first_id, first_id + count)
+    tconst = _tconst(ids)
+    # Titles share a name with probability ~20%, so the original-title match is not trivial.
+    names = 'Title ' + pd.Series(rng.integers(0, max(1000, int(0.8 * n_titles)), count)).astype(str)
+
+    # title.akas: one original row per title and Poisson(3.5) translations, ~2% rows repeated.
+    rows_per_title = rng.poisson(3.5, count) + 1
+    title_index = np.repeat(np.arange(count), rows_per_title)
+    position = np.arange(len(title_index)) - np.repeat(np.cumsum(rows_per_title) - rows_per_title, rows_per_title)
+    is_original = position == 0
+
+    region = _with_missing(rng, _choice(rng, REGION_WEIGHTS, len(position)), 0.05)
+    region[is_original] = np.nan
+    title = names.to_numpy()[title_index]
+    translated = ~is_original & (rng.random(len(position)) < 0.3)
+    title[translated] = title[translated] + ' (' + region[translated].fillna('XX').to_numpy() + ')'
+    akas = pd.DataFrame({
+        'titleId': tconst.to_numpy()[title_index],
+        'ordering': position + 1,
+        'title': title,
+        'region': region,
+        'language': _with_missing(rng, np.array(LANGUAGES, dtype=object)[rng.integers(0, len(LANGUAGES), len(position))], 0.8),
+        'types': np.where(is_original, 'original', None),
+        'attributes': None,
+        'isOriginalTitle': is_original.astype(int),
+    })
+    duplicated = np.flatnonzero(rng.random(len(akas)) < 0.02)
+    akas = akas.iloc[np.sort(np.concatenate([np.arange(len(akas)), duplicated]), kind='stable')]
+
+    # title.basics: mostly episodes, years skewed towards recent decades, ~5% missing years and genres.
+    years = pd.array(np.clip(2024 - rng.exponential(25, count).astype(int), 1890, 2024), dtype='Int32')
+    years[rng.random(count) < 0.05] = pd.NA
+    combination_weights = 1 / np.arange(1, len(genre_combinations) + 1)
+    genres = genre_combinations[rng.choice(len(genre_combinations), count, p=combination_weights / combination_weights.sum())]
+    basics = pd.DataFrame({
+        'tconst': tconst,
+        'titleType': _choice(rng, TITLE_TYPE_WEIGHTS, count),
+        'primaryTitle': names,
+        'originalTitle': names,
+        'isAdult': 0,
+        'startYear': years,
+        'endYear': None,
+        'runtimeMinutes': rng.integers(5, 180, count),
+        'genres': _with_missing(rng, genres, 0.05),
+    })
+
+    # title.ratings: ~15% of the titles, heavy-tailed number of votes. As on IMDb, about 0.1% of all
+    # titles are movies with more than 10k votes (task 1) and about 0.2% have more than 3k (task 3).
+    rated = np.flatnonzero(rng.random(count) < 0.15)
+    ratings = pd.DataFrame({
+        'tconst': tconst.to_numpy()[rated],
+        'averageRating': np.clip(rng.normal(6.6, 1.3, len(rated)), 1, 10).round(1),
+        'numVotes': (5 + rng.lognormal(5.8, 2.5, len(rated))).astype(int),
+    })
+    return akas, basics, ratings
+
+
+def _write_world_bank(rng, directory, mapping_path):
+    code_mapping = pd.read_csv(mapping_path)
+    countries = pd.concat([
+        code_mapping[['name', 'alpha-3']],
+        pd.DataFrame({'name': ['World', 'European Union'], 'alpha-3': ['WLD', 'EUU']}),
+    ], ignore_index=True)
+    for name, indicator, mean in [('gdp', 'GDP (current US$)', 23), ('population', 'Population, total', 15)]:
+        values = rng.lognormal(mean, 2, (len(countries), len(WORLD_BANK_YEARS)))
+        values[rng.random(values.shape) < 0.1] = np.nan
+        values[:, -1] = np.nan
+        frame = pd.DataFrame(values, columns=WORLD_BANK_YEARS)
+        frame.insert(0, 'Country Name', countries['name'].to_numpy())
+        frame.insert(1, 'Country Code', countries['alpha-3'].to_numpy())
+        frame.insert(2, 'Indicator Name', indicator)
+        frame.insert(3, 'Indicator Code', name)
+        with open(os.path.join(directory, name + '.csv'), 'w', encoding='utf-8') as f:
+            f.write('"Data Source","World Development Indicators",\n\n"Last Updated Date","2024-06-28",\n\n')
+            frame.to_csv(f, index=False, quoting=csv.QUOTE_ALL)
+    shutil.copy(mapping_path, os.path.join(directory, 'code_mapping.csv'))
+
+
+def generate_dataset(directory, n_titles, seed=0, block_size=200_000):
+    # Deterministic IMDb-shaped dumps with n_titles titles and matching World Bank files.
+    # Blocks of block_size titles are generated and appended, so memory does not grow with n_titles.
+    paths = {name: os.path.join(directory, name + '.tsv') for name in IMDB_HEADERS}
+    for name in ['gdp', 'population', 'code_mapping']:
+        paths[name] = os.path.join(directory, name + '.csv')
+    manifest_path = os.path.join(directory, 'dataset.json')
+    manifest = {'version': GENERATOR_VERSION, 'titles': n_titles, 'seed': seed}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            if {key: value for key, value in json.load(f).items() if key != 'rows'} == manifest:
+                return paths
+    except (OSError, ValueError):
+        pass
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    genre_combinations = np.array(sorted({
+        ','.join(sorted(rng.choice(GENRES, size=rng.integers(1, 4), replace=False))) for _ in range(600)
+    }), dtype=object)
+    rng.shuffle(genre_combinations)
+    rows = {name: 0 for name in IMDB_HEADERS}
+    for first_id in range(1, n_titles + 1, block_size):
+        frames = _imdb_block(rng, first_id, min(block_size, n_titles + 1 - first_id), n_titles, genre_combinations)
+        for name, frame in zip(['title.akas', 'title.basics', 'title.ratings'], frames):
+            _write_block(frame[IMDB_HEADERS[name]], paths[name], first_id == 1)
+            rows[name] += len(frame)
+    _write_world_bank(rng, directory, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'World_Bank_Data', 'code_mapping.csv'))
+
+    manifest['rows'] = rows
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return paths
+
+
+def compress_dataset(paths):
+    # Paths of gzip copies of the IMDb dumps, like the .tsv.gz files that IMDb distributes.
+    # Copies that are newer than their dump are reused.
+    compressed = dict(paths)
+    for name in IMDB_HEADERS:
+        compressed[name] = paths[name] + '.gz'
+        if not os.path.exists(compressed[name]) or os.stat(compressed[name]).st_mtime_ns < os.stat(paths[name]).st_mtime_ns:
+            with open(paths[name], 'rb') as source, gzip.open(compressed[name], 'wb', compresslevel=6) as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+    return compressed
+
+
+def measure(stage, function, *args, memory=True):
+    # Wall time, CPU time and (with memory) the peak RSS while function runs, of this process and summed
+    # over its worker processes (e.g. of --shards), and the memory held by the Arrow memory pool when it
+    # returns. RSS counts the memory of numpy, pandas and Arrow alike. The peaks are None where they
+    # cannot be reset, i.e. outside Linux.
+    if memory:
+        measured = reset_peak_rss() and all(reset_peak_rss(worker.pid) for worker in multiprocessing.active_children())
+    start, start_cpu = time.perf_counter(), time.process_time()
+    result = function(*args)
+    record = {'stage': stage, 'seconds': time.perf_counter() - start, 'cpu_seconds': time.process_time() - start_cpu}
+    if memory:
+        record['peak_rss_mb'] = peak_rss_since_reset_mb() if measured else None
+        # Workers started during the stage report their peak since they started. Pages shared with this
+        # process, e.g. after a fork, count in both.
+        workers = [peak_rss_since_reset_mb(worker.pid) for worker in multiprocessing.active_children()]
+        record['workers_peak_rss_mb'] = sum(peak for peak in workers if peak is not None) if measured else None
+        record['arrow_allocated_mb'] = pa.total_allocated_bytes() / 2 ** 20
+    return result, record
+
+
+def run_benchmark(paths, memory=True, shards=None, **options):
+    # Times every stage of the pipeline on one dataset. Stage times include loading their input files,
+    # which are also reported on their own as load_seconds.
+    if shards:
+        with ShardPool(shards) as shard_pool:
+            return run_benchmark(paths, memory, shard_pool=shard_pool, **options)
+    data = Data(
+        paths['title.akas'], paths['gdp'], paths['population'], paths['code_mapping'],
+        paths['title.ratings'], paths['title.basics'], 1800, 2100, **options,
+    )
+    stages = []
+    for stage, function in [('get_region', data.get_region), ('get_macro', data.get_macro), ('join_data', data.join_data)]:
+        stages.append(measure(stage, function, memory=memory)[1])
+    (best_movies_5, _, _), record = measure('task_1', best_movies_by_region, data.titles, memory=memory)
+    stages.append(record)
+    stages.append(measure('task_2', impact_ranking, data.titles, best_movies_5, memory=memory)[1])
+    stages.append(measure('task_3', polish_movies_by_year, data.titles, memory=memory)[1])
+    return {
+        'rows': {'title.akas': data.akas_length, 'title.basics': data.basics_length, 'title.ratings': data.ratings_length, 'titles': len(data.titles)},
+        'load_seconds': data.load_times,
+        'stages': stages,
+    }
+
+
+def compare(baseline, results, tolerance):
+    # Stages that got slower than the baseline by more than the tolerance, for datasets in both files.
+    regressions = []
+    baseline_runs = {run['titles']: run for run in baseline['runs']}
+    for run in results['runs']:
+        if run['titles'] not in baseline_runs:
+            continue
+        baseline_stages = {stage['stage']: stage for stage in baseline_runs[run['titles']]['stages']}
+        for stage in run['stages']:
+            before = baseline_stages.get(stage['stage'])
+            if before is not None and stage['seconds'] > before['seconds'] * (1 + tolerance):
+                regressions.append(f"{run['titles']} titles, {stage['stage']}: {before['seconds']:.3f}s -> {stage['seconds']:.3f}s")
+    return regressions
+
+
+def main(args):
+    options = {'join_backend': args.join_backend, 'engine': args.engine, 'chunksize': args.chunksize, 'shards': args.shards}
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'options': dict(options, gzip=args.gzip),
+        'runs': [],
+    }
+    for n_titles in args.titles:
+        paths = generate_dataset(os.path.join(args.directory, str(n_titles)), n_titles, args.seed)
+        if args.gzip:
+            paths = compress_dataset(paths)
+        run = run_benchmark(paths, memory=not args.no_memory, **options)
+        run['titles'] = n_titles
+        results['runs'].append(run)
+        for stage in run['stages']:
+            print(f"{n_titles} titles, {stage['stage']}: {stage['seconds']:.3f}s")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f'The benchmark results have been saved to {args.output}')
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the movie data pipeline on synthetic IMDb dumps")
+    parser.add_argument('--titles', type=int, nargs='+', default=[10_000, 100_000], help='Number of titles of each generated dataset')
+    parser.add_argument('--directory', type=str, default='benchmark_data', help='Directory for the generated datasets')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the data generator')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='Path of the json file with the results')
+    parser.add_argument('--compare', type=str, default=None, help='Json file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative slowdown reported as a regression by --compare')
+    parser.add_argument('--no_memory', action='store_true', help='Do not record the peak RSS and Arrow memory of the stages')
+    parser.add_argument('--join_backend', type=str, default='pandas', choices=['pandas', 'numpy'], help='Join backend of Data')
+    parser.add_argument('--engine', type=str, default='pandas', choices=ENGINES, help='Engine of Data')
+    parser.add_argument('--chunksize', type=int, default=None, help='Stream title.akas in blocks of this many rows')
+    parser.add_argument('--gzip', action='store_true', help='Read gzip copies of the IMDb dumps, like the .tsv.gz files of IMDb')
+    parser.add_argument('--shards', type=int, default=None, help='Resolve regions and join titles in this many processes')
+
+    args = parser.parse_args()
+    if args.engine == 'arrow' and args.join_backend == 'numpy':
+        parser.error('--engine arrow joins the titles itself and cannot be used with --join_backend numpy')
+    sys.exit(main(args))
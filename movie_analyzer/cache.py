@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import shutil
+
+import pandas as pd
+
+# Bump whenever the layout of the cached tables changes so old entries are re-parsed.
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = '.movie_analyzer_cache'
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def content_hash(path, block_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _entry_paths(cache_dir, path, options):
+    key = json.dumps({'source': os.path.abspath(path), 'options': options, 'version': CACHE_VERSION}, sort_keys=True, default=str)
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, name + '.parquet'), os.path.join(cache_dir, name + '.json')
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_cached(cache_dir, path, options, read=pd.read_parquet):
+    # An entry is valid when size and mtime match. If only the mtime moved (e.g. the dump was
+    # copied or touched) the content hash decides, so an identical file is still a hit.
+    # read parses the cached parquet file, e.g. arrow_engine.read_parquet for the arrow engine.
+    table_path, manifest_path = _entry_paths(cache_dir, path, options)
+    manifest = _read_manifest(manifest_path)
+    if manifest is None or not os.path.exists(table_path):
+        return None
+    signature = file_signature(path)
+    if manifest['size'] != signature['size']:
+        return None
+    if manifest['mtime_ns'] != signature['mtime_ns']:
+        if manifest['hash'] != content_hash(path):
+            return None
+        manifest.update(signature)
+        _write_manifest(manifest_path, manifest)
+    try:
+        return read(table_path)
+    except Exception as e:
+        print(f'Could not read the cached copy of {path}, parsing the file again: {e}')
+        return None
+
+
+def store_cached(cache_dir, path, options, data):
+    table_path, manifest_path = _entry_paths(cache_dir, path, options)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        data.to_parquet(table_path + '.tmp')
+        os.replace(table_path + '.tmp', table_path)
+        manifest = file_signature(path)
+        manifest['hash'] = content_hash(path)
+        manifest['source'] = os.path.abspath(path)
+        manifest['options'] = options
+        _write_manifest(manifest_path, manifest)
+    except Exception as e:
+        print(f'Could not cache {path}: {e}')
+
+
+def clear_cache(cache_dir):
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+        print(f'Cache {cache_dir} cleared.')
@@ -0,0 +1,98 @@
+import gzip
+import io
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed inputs by file suffix. The IMDb dumps are distributed as .tsv.gz.
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+
+def compression(path):
+    for suffix, name in COMPRESSIONS.items():
+        if str(path).endswith(suffix):
+            return name
+    return None
+
+
+def _open_compressed(path, name):
+    if name == 'gzip':
+        return gzip.open(path, 'rb')
+    if zstandard is None:
+        raise ImportError(f'Reading {path} requires the zstandard package')
+    return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+
+class DecompressingStream(io.RawIOBase):
+    # Binary stream of the decompressed content of path. A background thread decompresses blocks of
+    # block_size bytes ahead of the reader, at most queue_size of them, so decompression overlaps
+    # with parsing while memory stays bounded and nothing is written to disk.
+    def __init__(self, path, block_size=1 << 20, queue_size=8):
+        self.path = path
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=queue_size)
+        self.buffer = memoryview(b'')
+        self.done = False
+        self.stopped = threading.Event()
+        # Opened here, so a missing file raises FileNotFoundError in the caller.
+        self.source = _open_compressed(path, compression(path))
+        self.thread = threading.Thread(target=self._decompress, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decompress(self):
+        try:
+            with self.source as f:
+                while True:
+                    block = f.read(self.block_size)
+                    if not block or not self._put(block):
+                        break
+            self._put(b'')
+        except Exception as e:
+            # Raised again in the reading thread.
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, output):
+        if not self.buffer:
+            if self.done:
+                return 0
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                self.done = True
+                raise block
+            if not block:
+                self.done = True
+                return 0
+            self.buffer = memoryview(block)
+        size = min(len(output), len(self.buffer))
+        output[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+        super().close()
+
+
+def open_input(path, **kwargs):
+    # Buffered binary stream of a compressed input, or None for plain files, which are read directly.
+    if compression(path) is None:
+        return None
+    return io.BufferedReader(DecompressingStream(path, **kwargs), buffer_size=1 << 20)
@@ -1,5 +1,16 @@
+import csv
+import hashlib
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import pandas as pd
+import arrow_engine
+from cache import file_signature, load_cached, store_cached
+from compression import open_input
+from genres import fill_genre_masks, genre_masks
+from instrumentation import StageRecorder
+from store import YearStore, load_snapshot, read_store_metadata, save_snapshot, save_year_store, update_year_store
 
 mapping = {
     'US': 'EN',
@@ -30,12 +41,283 @@ mapping_countries = {
     'DE': 'International German',
 }
 
-def get_data(path, type, index_col=None, name=''):
+# Columns and types read from each IMDb dump. '\N' is IMDb's only null marker and is decoded by the parser.
+SCHEMAS = {
+    'title.akas': {
+        'usecols': ['titleId', 'title', 'region', 'language', 'isOriginalTitle'],
+        'dtype': {'title': 'object', 'region': 'category', 'language': 'category', 'isOriginalTitle': 'Int8'},
+    },
+    'title.ratings': {
+        'usecols': ['tconst', 'averageRating', 'numVotes'],
+        'dtype': {'averageRating': 'Float64', 'numVotes': 'Int32'},
+    },
+    'title.basics': {
+        'usecols': ['tconst', 'titleType', 'startYear', 'genres'],
+        'dtype': {'titleType': 'category', 'startYear': 'Int32', 'genres': 'category'},
+    },
+}
+
+# Frames kept next to the titles store so it can be refreshed from new dumps.
+SNAPSHOT_FRAMES = ['region_stats', 'lost_region', 'original_titles', 'akas_hashes', 'ratings_hashes', 'basics_hashes']
+
+# Counters reported in the results, kept in the titles store next to the joined table.
+STORE_COUNTERS = [
+    'akas_length', 'unique_movies_length', 'found_region_length', 'lost_region_count',
+    'ratings_length', 'basics_length', 'titles_length',
+]
+
+def empty_table(name):
+    # A table with no rows and the columns and types of SCHEMAS[name], indexed by its first column.
+    schema = SCHEMAS[name]
+    columns = {column: pd.Series(dtype=schema['dtype'][column]) for column in schema['usecols'][1:]}
+    return pd.DataFrame(columns, index=pd.Index([], dtype=object, name=schema['usecols'][0]))
+
+def concat_tables(frames, name):
+    # pd.concat of the frames with rows, or the empty table of SCHEMAS[name] when there are none.
+    frames = [frame for frame in frames if len(frame)]
+    return pd.concat(frames) if frames else empty_table(name)
+
+def replace_categories(series, replacements):
+    # Equivalent of Series.replace for a categorical column: only the categories are rewritten.
+    series = series.astype('category')
+    replaced = pd.Index([replacements.get(c, c) for c in series.cat.categories], dtype=object)
+    categories = replaced.unique()
+    remap = np.append(categories.get_indexer(replaced), -1)
+    codes = remap[series.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, categories), index=series.index, name=series.name)
+
+def resolve_regions(title_ids, title_codes, region_values, region_codes):
+    # Number of distinct regions and the last region of every title, computed on integer codes.
+    # title_codes and region_codes point into title_ids and region_values and are in file order.
+    title_codes = np.asarray(title_codes, dtype=np.int64)
+    region_codes = np.asarray(region_codes, dtype=np.int64)
+    if len(title_codes) == 0:
+        return pd.DataFrame({'nunique': [], 'last': []}, index=pd.Index([], dtype=object, name='titleId')).astype({'nunique': np.int64})
+    # First occurrence in the reversed codes is the last occurrence in file order.
+    present, last_reversed = np.unique(title_codes[::-1], return_index=True)
+    last = region_codes[len(title_codes) - 1 - last_reversed]
+    # Distinct (title, region) pairs come out sorted by title, so run lengths are the nunique per title.
+    n_regions = region_codes.max() + 1
+    pair_titles = np.unique(title_codes * n_regions + region_codes) // n_regions
+    boundaries = np.flatnonzero(np.diff(pair_titles)) + 1
+    nunique = np.diff(np.concatenate([[0], boundaries, [len(pair_titles)]]))
+    return pd.DataFrame(
+        {'nunique': nunique, 'last': pd.Index(region_values).take(last).to_numpy()},
+        index=pd.Index(pd.Index(title_ids).take(present), name='titleId'),
+    ).sort_index()
+
+def match_original_titles(titles, is_original):
+    # Whether every title equals the title of any row where is_original, compared through integer codes.
+    names, name_values = pd.factorize(titles, use_na_sentinel=False)
+    original_names = np.zeros(len(name_values), dtype=bool)
+    original_names[names[is_original]] = True
+    return original_names[names]
+
+def find_regions(titles, original_titles=None, resolve=resolve_regions, match=match_original_titles):
+    # Region statistics of title.akas rows with mapped regions, and the rows of the titles without a
+    # single region. A translation with a region is used when its title matches any original title;
+    # these come from titles itself unless original_titles is given. Titles, titleIds and regions
+    # are compared through their integer codes only.
+    region_codes = titles['region'].cat.codes.to_numpy()
+    if original_titles is None:
+        # match is match_original_titles, or the same computation split across processes (see sharding.py).
+        matches = match(titles['title'], (titles.isOriginalTitle == 1).to_numpy(dtype=bool, na_value=False))
+    else:
+        matches = pd.Index(original_titles).get_indexer(titles['title']) >= 0
+    candidates = (
+        matches &
+        (titles.isOriginalTitle == 0).to_numpy(dtype=bool, na_value=False) &
+        (region_codes >= 0)
+    )
+    title_codes, title_ids = pd.factorize(titles.index)
+    # resolve is resolve_regions, or the same computation split across processes (see sharding.py).
+    regions = resolve(
+        title_ids, title_codes[candidates], titles['region'].cat.categories, region_codes[candidates]
+    )
+
+    lost_titles = np.zeros(len(title_ids), dtype=bool)
+    lost_titles[title_ids.get_indexer(regions.index[regions['nunique'] != 1])] = True
+    lost_region = titles.loc[lost_titles[title_codes]]
+    # Duplicates are rows repeated within the same title, so titleId is part of the comparison.
+    lost_region = lost_region.loc[~lost_region.reset_index().duplicated(keep='first').to_numpy()]
+    return regions, lost_region
+
+def prepend_rows(first, frame):
+    # pd.concat([first, frame]) which keeps the categorical columns categorical. Their categories are
+    # extended with those of first, so the codes of frame are unchanged.
+    first = first.copy()
+    for column in frame.columns:
+        if isinstance(frame[column].dtype, pd.CategoricalDtype):
+            categories = frame[column].cat.categories
+            categories = categories.append(first[column].cat.categories.difference(categories))
+            first[column] = first[column].cat.set_categories(categories)
+            frame = frame.assign(**{column: frame[column].cat.set_categories(categories)})
+    return pd.concat([first, frame])
+
+def increasing_ids(ids):
+    # Whether ids are strictly increasing, ordered by length first, so 'tt9999999' < 'tt10000000'.
+    ids = pd.Index(ids).astype(str)
+    lengths = ids.str.len().to_numpy()
+    longer, same = lengths[1:] > lengths[:-1], lengths[1:] == lengths[:-1]
+    return bool((longer | (same & (ids[1:].to_numpy() > ids[:-1].to_numpy()))).all())
+
+def title_keys(ids):
+    # Integer key of IMDb identifiers, 'tt0000001' -> 1, computed on the raw bytes of the ids, with the
+    # number of digits of every id (see parse_title_keys).
+    return parse_title_keys(title_bytes(ids))
+
+def title_bytes(ids):
+    return np.asarray(pd.Index(ids).astype(str), dtype=bytes)
+
+def parse_title_keys(ids):
+    # Keys of ids given as a fixed-width bytes array and the number of digits of every id, -1 where the id
+    # is not 'tt' followed by 1 to 9 digits, so that its key fits 32 bits.
+    characters = ids.view(np.uint8).reshape(len(ids), -1) if len(ids) else np.zeros((0, 0), dtype=np.uint8)
+    lengths = np.char.str_len(ids) - 2
+    digits = characters[:, 2:].astype(np.int32) - ord('0')
+    is_digit = (digits >= 0) & (digits <= 9)
+    keys = np.zeros(len(ids), dtype=np.int32)
+    for column, column_is_digit in zip(digits.T, is_digit.T):
+        keys = np.where(column_is_digit, keys * 10 + column, keys)
+    valid = (lengths >= 1) & (lengths <= 9) & (is_digit.sum(axis=1) == lengths)
+    if characters.shape[1] >= 2:
+        valid &= (characters[:, 0] == ord('t')) & (characters[:, 1] == ord('t'))
+    return keys, np.where(valid, lengths, -1).astype(np.int8)
+
+def key_widths(keys, widths):
+    # Whether all ids are valid, their smallest number of digits and the numbers of digits of the ids
+    # with leading zeros, for keys_identify_ids.
+    key_digits = np.searchsorted(10 ** np.arange(1, 10), keys, side='right') + 1
+    padded = np.unique(widths[widths > key_digits]).tolist()
+    return bool((widths >= 0).all()), int(widths.min(initial=9)), padded
+
+def keys_identify_ids(summaries):
+    # Whether equal keys stand for equal ids in all tables given by key_widths: every id is 'tt' followed by
+    # digits, and the ids with leading zeros are padded to the width of the shortest one, so 'tt1' and
+    # 'tt01' never occur together.
+    if not all(valid for valid, _, _ in summaries):
+        return False
+    width = min(shortest for _, shortest, _ in summaries)
+    return all(padded == width for _, _, widths in summaries for padded in widths)
+
+def sorted_title_keys(keys):
+    # Keys of a table in ascending order and the row order producing them (None if already sorted).
+    if len(keys) == 0 or (np.diff(keys) >= 0).all():
+        return keys, None
+    order = np.argsort(keys, kind='stable')
+    return keys[order], order
+
+def lookup_title_keys(sorted_keys, order, keys):
+    # Row positions of keys in a table given by sorted_title_keys, -1 where a key is missing.
+    positions = np.searchsorted(sorted_keys, keys)
+    positions[positions == len(sorted_keys)] = 0
+    found = (sorted_keys[positions] == keys) if len(sorted_keys) else np.zeros(len(keys), dtype=bool)
+    if order is not None and len(order):
+        positions = order[positions]
+    return np.where(found, positions, -1)
+
+def take_rows(frame, positions, index):
+    # Rows of frame at positions with missing values where the position is -1, like a left join.
+    return pd.DataFrame(
+        {column: pd.api.extensions.take(frame[column].values, positions, allow_fill=True) for column in frame.columns},
+        index=index,
+    )
+
+def join_titles(region, tables, macro_data):
+    # Same result as region.join(tables, how='left') followed by the merge with macro_data,
+    # computed with integer title keys and region codes instead of hashing strings. None when the
+    # keys do not identify the ids (see keys_identify_ids) or repeat within a table.
+    keys, widths = title_keys(region.index)
+    parsed = [title_keys(table.index) for table in tables]
+    if not keys_identify_ids([key_widths(keys, widths)] + [key_widths(*table_keys) for table_keys in parsed]):
+        return None
+    joined = [region]
+    for table, (table_keys, _) in zip(tables, parsed):
+        sorted_keys, order = sorted_title_keys(table_keys)
+        if (np.diff(sorted_keys) == 0).any():
+            return None
+        joined.append(take_rows(table, lookup_title_keys(sorted_keys, order, keys), region.index))
+    joined.append(take_macro_rows(region, macro_data))
+    return fill_genre_masks(pd.concat(joined, axis=1))
+
+def join_titles_arrow(region, tables, macro_data):
+    # Same result as join_titles, with the title ids looked up in Arrow hash tables.
+    joined = [region]
+    for table in tables:
+        joined.append(take_rows(table, arrow_engine.lookup_titles(region.index, table.index), region.index))
+    joined.append(take_macro_rows(region, macro_data))
+    return fill_genre_masks(pd.concat(joined, axis=1))
+
+def take_macro_rows(region, macro_data):
+    # Rows of macro_data for the region of every title, joined through the distinct regions only.
+    region_codes, region_values = pd.factorize(region['region'])
+    macro_positions = np.append(macro_data.index.get_indexer(region_values), -1)[region_codes]
+    return take_rows(macro_data, macro_positions, region.index)
+
+def key_hashes(frame, by_title=False):
+    # 64-bit hash of every row, or with by_title the wrapping sum of the row hashes of each title.
+    # The sum ignores the order of the rows of a title, which does not change its region.
+    hashes = pd.util.hash_pandas_object(frame, index=True).to_numpy()
+    if not by_title:
+        return pd.DataFrame({'hash': hashes}, index=frame.index)
+    return sum_hashes(hashes, frame.index)
+
+def sum_hashes(hashes, index):
+    # Wrapping sum of the hashes of every key of index, with the keys in order of first occurrence.
+    # Sums of the chunks of a frame sum again to the sums of the whole frame.
+    codes, keys = pd.factorize(index)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+    sums = np.add.reduceat(hashes[order], starts) if len(order) else hashes
+    return pd.DataFrame({'hash': sums}, index=pd.Index(keys, name=index.name))
+
+def changed_keys(old, new):
+    # Keys added, removed or with a different hash between two key_hashes results.
+    positions = old.index.get_indexer(new.index)
+    old_hashes = old['hash'].to_numpy()
+    differs = (positions == -1) | (old_hashes[positions] != new['hash'].to_numpy())
+    return new.index[differs].append(old.index[~old.index.isin(new.index)])
+
+def canonical(frame):
+    # Rows in a fixed order with categoricals as plain values, to compare frames built differently.
+    frame = frame.reset_index()
+    frame = frame.astype({c: object for c in frame.columns if isinstance(frame[c].dtype, pd.CategoricalDtype)})
+    return frame.sort_values(list(frame.columns), kind='stable', ignore_index=True)
+
+def get_data(path, type, index_col=None, name='', cache_dir=None, schema=None, chunksize=None, engine='pandas'):
+    stream = None
     try:
-        if type == 'imdb':
-            data = pd.read_csv(path, index_col=index_col, sep='\t')
+        options = {'type': type, 'index_col': index_col, 'schema': schema, 'engine': engine}
+        # A chunked read returns an iterator over the file and never goes through the cache.
+        if cache_dir is not None and chunksize is None:
+            data = load_cached(cache_dir, path, options, arrow_engine.read_parquet if engine == 'arrow' else pd.read_parquet)
+            if data is not None:
+                return data
+        # Compressed files are decompressed on a background thread while they are parsed.
+        stream = open_input(path)
+        source = path if stream is None else stream
+        if type == 'imdb' and schema is not None and engine == 'arrow':
+            if chunksize is not None:
+                data = arrow_engine.read_imdb_chunks(source, schema, index_col, chunksize)
+                chunks, stream = read_chunks(data, stream), None
+                return chunks
+            data = arrow_engine.read_imdb(source, schema, index_col)
+        elif type == 'imdb' and schema is not None:
+            data = pd.read_csv(
+                source, index_col=index_col, sep='\t', usecols=schema['usecols'], dtype=schema['dtype'],
+                na_values=['\\N'], keep_default_na=False, quoting=csv.QUOTE_NONE, chunksize=chunksize,
+            )
+            if chunksize is not None:
+                chunks, stream = read_chunks(data, stream), None
+                return chunks
+        elif type == 'imdb':
+            data = pd.read_csv(source, index_col=index_col, sep='\t')
         elif type == 'world_bank':
-            data = pd.read_csv(path, skiprows=3, sep=',')
+            data = pd.read_csv(source, skiprows=3, sep=',')
+        elif type == 'csv':
+            data = pd.read_csv(source, index_col=index_col)
+        if cache_dir is not None:
+            store_cached(cache_dir, path, options, data)
         return data
     except FileNotFoundError:
         print(f"The file {name} was not found. Please check the file")
@@ -45,9 +327,26 @@ def get_data(path, type, index_col=None, name=''):
         print(f"The file {name} is empty. Please provide a valid CSV file.")
     except Exception as e:
         print(f"An unexpected error occurred while getting file {name}: {e}")
+    finally:
+        # Chunked reads hand the stream over to read_chunks, which closes it once the chunks are consumed.
+        if stream is not None:
+            stream.close()
+
+def read_chunks(chunks, stream=None):
+    # Chunks of a chunked read. The decompressing stream is closed once they are consumed or abandoned.
+    try:
+        yield from chunks
+    finally:
+        if stream is not None:
+            stream.close()
+
+def timed_get_data(*args, **kwargs):
+    start = time.perf_counter()
+    data = get_data(*args, **kwargs)
+    return data, time.perf_counter() - start
 
 class Data:
-    def __init__(self, titles_akas_path, gdp_path, population_path, mapping_path, ratings_path, basics_path, start_year, end_year, world=True):
+    def __init__(self, titles_akas_path, gdp_path, population_path, mapping_path, ratings_path, basics_path, start_year, end_year, world=True, cache_dir=None, chunksize=None, join_backend='pandas', prefetch=False, workers=None, prefetch_pool='thread', recorder=None, shard_pool=None, engine='pandas', snapshot=False):
         self.titles_akas_path = titles_akas_path
         self.gdp_path = gdp_path
         self.population_path = population_path
@@ -57,31 +356,194 @@ class Data:
         self.start_year = start_year
         self.end_year = end_year
         self.include_world = world
+        self.cache_dir = cache_dir
+        self.chunksize = chunksize
+        self.join_backend = join_backend
+        if engine == 'arrow' and join_backend == 'numpy':
+            print("join_backend='numpy' is ignored with engine='arrow', which joins the titles with Arrow hash lookups.")
+        self.workers = workers
+        self.prefetch_pool = prefetch_pool
+        self.load_times = {}
+        self._pending_loads = {}
+        self.recorder = recorder if recorder is not None else StageRecorder()
+        self.shard_pool = shard_pool
+        self.engine = engine
+        # With snapshot the row hashes of the inputs are kept while they are loaded, so build_year_store
+        # can save what refresh needs without reading them again.
+        self.snapshot = snapshot
+        self.snapshot_frames = {}
 
         if self.end_year < self.start_year:
             print(f'End date smaller than start date. Performing analysis for {start_year} only.')
             self.end_year = self.start_year
+        if prefetch:
+            self.load_all()
+
+    def _sources(self):
+        return {
+            'title.akas': (self.titles_akas_path, 'imdb', 'titleId', 'titles.akas', self.cache_dir, SCHEMAS['title.akas'], None, self.engine),
+            'gdp': (self.gdp_path, 'world_bank', None, 'gdp', self.cache_dir),
+            'population': (self.population_path, 'world_bank', None, 'population', self.cache_dir),
+            'code_mapping': (self.mapping_path, 'csv', 'alpha-3', 'code_mapping', self.cache_dir),
+            'title.ratings': (self.ratings_path, 'imdb', 'tconst', 'title.ratings', self.cache_dir, SCHEMAS['title.ratings'], None, self.engine),
+            'title.basics': (self.basics_path, 'imdb', 'tconst', 'title.basics', self.cache_dir, SCHEMAS['title.basics'], None, self.engine),
+        }
+
+    def load_all(self, workers=None):
+        # Start loading every input file in the background. Each stage then picks up its frames
+        # through _load, waiting only for the files it needs.
+        sources = self._sources()
+        if self.chunksize is not None:
+            # title.akas is streamed by get_region_chunked and never loaded whole.
+            del sources['title.akas']
+        sources = {name: args for name, args in sources.items() if name not in self._pending_loads}
+        pool = ProcessPoolExecutor if self.prefetch_pool == 'process' else ThreadPoolExecutor
+        executor = pool(max_workers=workers or self.workers or len(sources) or 1)
+        for name, args in sources.items():
+            self._pending_loads[name] = executor.submit(timed_get_data, *args)
+        executor.shutdown(wait=False)
+
+    def _load(self, name):
+        if name in self._pending_loads:
+            data, seconds = self._pending_loads.pop(name).result()
+            self.recorder.add(f'load {name}', seconds, rows_out=len(data))
+        else:
+            with self.recorder.stage(f'load {name}') as stage:
+                data, seconds = timed_get_data(*self._sources()[name])
+                stage['rows_out'] = len(data)
+        self.load_times[name] = seconds
+        print(f'Loaded {name} in {seconds:.2f}s')
+        return data
 
     def get_region(self):
-        titles = get_data(self.titles_akas_path, 'imdb', 'titleId', 'titles.akas')
-        self.akas_length = len(titles)
-        titles = titles.replace({'\\N': np.NaN})
-        titles_og = titles.loc[titles.isOriginalTitle == 1, 'title'].sort_values()
-        self.unique_movies_length = len(titles_og) 
-        titles.region = titles.region.replace(mapping)
-        titles = titles.drop_duplicates(keep='first')
-        titles_og = titles.loc[
-            titles.title.isin(titles_og) &
-            (titles.isOriginalTitle == 0) &
-            (~titles.region.isna())
-        ].groupby('titleId').agg(['nunique', 'last'])
-
-        self.lost_region_count = len(titles_og.loc[titles_og['region']['nunique'] != 1, 'region'][['last']])
-        self.lost_region = titles.loc[titles.index.isin(titles_og.loc[titles_og['region']['nunique'] != 1].index)].copy()
+        with self.recorder.stage('get_region') as stage:
+            if self.chunksize is not None:
+                self.get_region_chunked()
+            else:
+                titles = self._load('title.akas')
+                self.akas_length = len(titles)
+                is_original = (titles.isOriginalTitle == 1).to_numpy(dtype=bool, na_value=False)
+                self.unique_movies_length = int(is_original.sum())
+                titles['region'] = replace_categories(titles['region'], mapping)
+                if self.snapshot:
+                    self._scan_akas([titles], hashes=True)
+                self._set_region(*find_regions(titles, resolve=self._resolve, match=self._match))
+            stage['rows_in'] = self.akas_length
+            stage['rows_out'] = len(self.region)
+
+    def get_region_chunked(self):
+        # Same result as get_region, but title.akas is streamed in blocks of self.chunksize rows.
+        # Pass 1 collects the original titles. Pass 2 reduces each block to its distinct (titleId, region)
+        # pairs and keeps the rows of the titles without a single region. The rows of the last title of a
+        # block are held back until the next one, so this is exact when the rows of every title are
+        # together, as in the IMDb files. Titles in increasing order show that; otherwise pass 3 gathers
+        # the rows of these titles once all pairs are known.
+        original_titles = self._scan_akas(self._read_akas_chunks(), self.snapshot)
+
+        pairs = []
+        pairs_length = 0
+        compacted_length = 0
+        self.pair_compactions = 0
+        lost_region = []
+        ordered = True
+        held = None
+        chunks = self._read_akas_chunks()
+        while True:
+            chunk = next(chunks, None)
+            if chunk is None:
+                if held is None:
+                    break
+                chunk, held = held, None
+            else:
+                if held is not None:
+                    chunk = prepend_rows(held, chunk)
+                ids = chunk.index.to_numpy()
+                held_rows = ids == ids[-1]
+                ordered = ordered and increasing_ids(ids[np.append(True, ids[1:] != ids[:-1])])
+                held, chunk = chunk.loc[held_rows], chunk.loc[~held_rows]
+            candidates = chunk.loc[
+                (original_titles.get_indexer(chunk.title) >= 0) &
+                (chunk.isOriginalTitle == 0) &
+                (~chunk.region.isna()),
+                ['region'],
+            ]
+            candidates = candidates.reset_index().astype({'region': object}).drop_duplicates(keep='last')
+            if ordered:
+                counts = candidates['titleId'].value_counts()
+                lost_region.append(chunk.loc[chunk.index.isin(counts.index[counts > 1])])
+            pairs.append(candidates)
+            pairs_length += len(candidates)
+            # Keep the partial results bounded by the number of distinct pairs seen so far. The threshold
+            # doubles with the distinct pairs, so the number of compactions stays logarithmic.
+            if pairs_length > max(4 * self.chunksize, 2 * compacted_length):
+                pairs = [pd.concat(pairs).drop_duplicates(keep='last')]
+                pairs_length = compacted_length = len(pairs[0])
+                self.pair_compactions += 1
+        if pairs:
+            pairs = pd.concat(pairs).drop_duplicates(keep='last')
+        else:
+            pairs = pd.DataFrame({'titleId': pd.Series(dtype=object), 'region': pd.Series(dtype=object)})
+        # Only distinct pairs are left, in order of their last occurrence, so nunique and last are unchanged.
+        title_codes, title_ids = pd.factorize(pairs['titleId'])
+        region_codes, region_values = pd.factorize(pairs['region'])
+        regions = self._resolve(title_ids, title_codes, region_values, region_codes)
+
+        if not ordered:
+            lost_ids = pd.Index(regions.index[regions['nunique'] != 1])
+            lost_region = [chunk.loc[lost_ids.get_indexer(chunk.index) >= 0] for chunk in self._read_akas_chunks()]
+        lost_region = concat_tables(lost_region, 'title.akas')
+        lost_region = lost_region.loc[~lost_region.reset_index().duplicated(keep='first').to_numpy()]
+        lost_region = lost_region.astype({'region': 'category', 'language': 'category'})
+        self._set_region(regions, lost_region)
+
+    def _scan_akas(self, chunks, hashes=False):
+        # Row counters and the original titles of title.akas, in order of first occurrence, in one pass
+        # over chunks. With hashes the title hashes and original titles are kept for the snapshot.
+        self.akas_length = 0
+        self.unique_movies_length = 0
+        original_titles, title_hashes = [], []
+        for chunk in chunks:
+            self.akas_length += len(chunk)
+            is_original = (chunk.isOriginalTitle == 1).to_numpy(dtype=bool, na_value=False)
+            self.unique_movies_length += int(is_original.sum())
+            original_titles.append(pd.unique(chunk.loc[is_original, 'title'].to_numpy(dtype=object)))
+            if hashes:
+                title_hashes.append(key_hashes(chunk, by_title=True))
+        original_titles = pd.Index(pd.unique(np.concatenate(original_titles or [np.zeros(0, dtype=object)])), dtype=object)
+        if hashes:
+            title_hashes = pd.concat(title_hashes)
+            self.snapshot_frames['original_titles'] = pd.DataFrame({'title': original_titles})
+            self.snapshot_frames['akas_hashes'] = sum_hashes(title_hashes['hash'].to_numpy(), title_hashes.index)
+        return original_titles
+
+    def _read_akas_chunks(self):
+        chunks = get_data(
+            self.titles_akas_path, 'imdb', 'titleId', 'titles.akas', schema=SCHEMAS['title.akas'], chunksize=self.chunksize,
+            engine=self.engine,
+        )
+        for chunk in chunks:
+            chunk['region'] = replace_categories(chunk['region'], mapping)
+            yield chunk
+
+    def _resolve(self, title_ids, title_codes, region_values, region_codes):
+        if self.shard_pool is not None:
+            return self.shard_pool.resolve_regions(title_ids, title_codes, region_values, region_codes)
+        return resolve_regions(title_ids, title_codes, region_values, region_codes)
+
+    def _match(self, titles, is_original):
+        if self.shard_pool is not None:
+            return self.shard_pool.match_original_titles(titles, is_original)
+        return match_original_titles(titles, is_original)
+
+    def _set_region(self, regions, lost_region):
+        # regions holds the number of distinct regions and the last region of every title with a translation.
+        self.lost_region_count = int((regions['nunique'] != 1).sum())
+        self.lost_region = lost_region
         international_titles = self.lost_region.loc[lambda x: x['isOriginalTitle'] == 1].copy()
         international_titles['region'] = 'WD'
 
-        titles_x_country = titles_og.loc[titles_og['region']['nunique'] == 1, 'region'][['last']]
+        self.region_stats = regions
+        titles_x_country = regions.loc[regions['nunique'] == 1, ['last']]
         self.found_region_length = len(titles_x_country)
         titles_x_country.columns = ['region']
         if self.include_world:
@@ -95,48 +557,247 @@ class Data:
         print(f'The region for {self.lost_region_count} movies not found. To check manually these titles check self.lost_region')
         print(self.lost_region.head())
 
+    def get_macro_panel(self, years=None):
+        # GDP and population of every region for all years in the World Bank files, indexed by
+        # (alpha-2, year). The files are parsed once and the panel is kept for later calls.
+        if not hasattr(self, 'macro_panel'):
+            gdp = self._load('gdp')
+            population = self._load('population')
+            gdp_years = [c for c in gdp.columns if str(c).isdigit()]
+            population_years = [c for c in population.columns if str(c).isdigit()]
+            self.macro_years = sorted(int(c) for c in set(gdp_years) & set(population_years))
+
+            gdp = gdp.melt(['Country Code', 'Country Name'], gdp_years, var_name='year', value_name='gdp')
+            population = population.melt(['Country Code'], population_years, var_name='year', value_name='population')
+            macro_panel = gdp.merge(population, on=['Country Code', 'year'], how='left')
+            macro_panel['year'] = macro_panel['year'].astype(int)
+
+            code_mapping = self._load('code_mapping')
+            code_mapping.loc['WLD'] = 'WD'
+            macro_panel['alpha-2'] = macro_panel['Country Code'].map(code_mapping['alpha-2'].replace(mapping))
+            macro_panel['regionName'] = macro_panel['alpha-2'].map(mapping_countries).fillna(macro_panel['Country Name'])
+            macro_panel = macro_panel.groupby(['alpha-2', 'year']).agg({'gdp': 'sum', 'population': 'sum', 'regionName': 'first'})
+            macro_panel['gdp_pc'] = macro_panel['gdp'] / macro_panel['population']
+            self.macro_panel = macro_panel
+
+        if years is None:
+            return self.macro_panel
+        return self.macro_panel.loc[self.macro_panel.index.get_level_values('year').isin([int(y) for y in years])]
+
     def get_macro(self, year='2022'):
-        gdp = get_data(self.gdp_path, 'world_bank')
-        population = get_data(self.population_path, 'world_bank')
-
-        if (len(gdp.filter(like=year).columns) == 0) or (len(population.filter(like=year).columns) == 0):
-            print(f'There is no data for year {year}.')
-            return -1
-
-        gdp = gdp[['Country Code', 'Country Name', year]]
-        gdp.columns = ['country_id', 'regionName', 'gdp']
-        gdp = gdp.set_index('country_id')
-
-        population = population[['Country Code', 'Country Name', year]]
-        population.columns = ['country_id', 'regionName', 'population']
-        population = population.set_index('country_id')
-        macro_data = gdp.join(population[['population']])
-        code_mapping = pd.read_csv(self.mapping_path, index_col='alpha-3')
-        code_mapping.loc['WLD'] = 'WD'
-        macro_data = macro_data.join(code_mapping[['alpha-2']])
-        macro_data['alpha-2'] = macro_data['alpha-2'].replace(mapping)
-        macro_data['regionName'] = macro_data.apply(lambda row: mapping_countries.get(row['alpha-2'], row['regionName']), axis=1)
-        macro_data = macro_data.groupby('alpha-2').agg({'gdp': 'sum', 'population': 'sum', 'regionName': 'first'})
-        macro_data['gdp_pc'] = macro_data['gdp'] / macro_data['population']
-        self.macro_data = macro_data
-
-        return self.macro_data
+        with self.recorder.stage('get_macro') as stage:
+            macro_panel = self.get_macro_panel()
+            stage['rows_in'] = len(macro_panel)
+            if not str(year).isdigit() or int(year) not in self.macro_years:
+                print(f'There is no data for year {year}.')
+                return -1
+
+            self.macro_year = int(year)
+            self.macro_data = macro_panel.xs(int(year), level='year')
+            stage['rows_out'] = len(self.macro_data)
+            return self.macro_data
 
     def join_data(self):
+        titles = self.join_all_years()
+        self.titles = titles.loc[lambda x: (x['startYear'] >= self.start_year) & (x['startYear'] <= self.end_year)].copy()
+        return self.titles
+
+    def join_all_years(self):
         if not hasattr(self, 'region'):
             print('No region data loaded. Transforming the data first.')
             self.get_region()
         if not hasattr(self, 'macro_data'):
             print('No macro data loaded. Transforming the data first.')
             self.get_macro()
-        ratings = get_data(self.ratings_path, 'imdb', 'tconst', 'title.ratings')
+        with self.recorder.stage('join_data') as stage:
+            ratings = self._load('title.ratings')
+            self.ratings_length = len(ratings)
+            basics = self._load('title.basics')
+            self.basics_length = len(basics)
+            if self.snapshot:
+                self.snapshot_frames['ratings_hashes'] = key_hashes(ratings)
+                self.snapshot_frames['basics_hashes'] = key_hashes(basics)
+            titles = self._join(self.region, ratings, basics)
+            self.titles_length = len(titles)
+            titles = titles.dropna(subset=['startYear'])
+            stage['rows_in'] = len(self.region) + self.ratings_length + self.basics_length
+            stage['rows_out'] = len(titles)
+            return titles
+
+    def _join(self, region, ratings, basics):
+        # Genre predicates on the joined titles are bitwise operations on genreMask, see genres.py.
+        if 'genres' in basics.columns:
+            basics = basics.assign(genreMask=genre_masks(basics['genres']))
+        if self.engine == 'arrow' and self.shard_pool is None:
+            return join_titles_arrow(region, [ratings, basics], self.macro_data)
+        if self.shard_pool is not None or self.join_backend == 'numpy':
+            join = self.shard_pool.join_titles if self.shard_pool is not None else join_titles
+            titles = join(region, [ratings, basics], self.macro_data)
+            if titles is not None:
+                return titles
+            print('The title ids are not IMDb identifiers of one width, joining the titles on the ids instead.')
+        titles = region.join([ratings, basics], how='left')
+        return fill_genre_masks(pd.merge(titles, self.macro_data, left_on='region', right_index=True, how='left'))
+
+    def _store_key(self, macro_year):
+        sources = {name: file_signature(args[0]) for name, args in self._sources().items()}
+        return {'sources': sources, 'world': bool(self.include_world), 'macro_year': int(macro_year)}
+
+    def data_version(self):
+        # Changes whenever an input file or an option the joined titles depend on changes.
+        key = json.dumps(self._store_key(self.macro_year), sort_keys=True)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def build_year_store(self, directory):
+        # Joins all years once and persists the result, so any year range is a slice of the store.
+        # With snapshot the row hashes of the inputs are kept as well, so refresh can update the store.
+        with self.recorder.stage('build_year_store') as stage:
+            self._build_year_store(directory)
+            stage['rows_out'] = len(self.year_store)
+        return self.year_store
+
+    def _build_year_store(self, directory):
+        titles = self.join_all_years()
+        metadata = {
+            'key': self._store_key(self.macro_year),
+            'counters': {counter: getattr(self, counter) for counter in STORE_COUNTERS},
+        }
+        save_year_store(titles, directory, metadata)
+        if self.snapshot:
+            save_snapshot(directory, {'region_stats': self.region_stats, 'lost_region': self.lost_region, **self.snapshot_frames})
+        self.year_store = YearStore(directory)
+
+    def refresh(self, directory, macro_year='2022'):
+        with self.recorder.stage('refresh') as stage:
+            refreshed = self._refresh(directory, macro_year)
+            if refreshed:
+                stage['rows_out'] = len(self.year_store)
+            return refreshed
+
+    def _refresh(self, directory, macro_year):
+        # Updates a store built with snapshot=True to the current IMDb dumps. Only the titles whose
+        # title.akas rows changed, or whose translations match an added or removed original title,
+        # are resolved again, and only those and the titles with changed ratings or basics are
+        # joined again and rewritten in the years they leave or enter. Returns False when the store
+        # cannot be refreshed and must be rebuilt.
+        metadata = read_store_metadata(directory)
+        snapshot = load_snapshot(directory, SNAPSHOT_FRAMES)
+        if metadata is None or snapshot is None:
+            return False
+        try:
+            key = self._store_key(macro_year)
+        except OSError:
+            return False
+        old_key = metadata['key']
+        if any(key[option] != old_key[option] for option in ['world', 'macro_year']) or any(
+            key['sources'][name] != old_key['sources'][name] for name in ['gdp', 'population', 'code_mapping']
+        ):
+            return False
+
+        if self.chunksize is None:
+            akas = self._load('title.akas')
+            akas['region'] = replace_categories(akas['region'], mapping)
+            read_akas = lambda: [akas]
+        else:
+            read_akas = self._read_akas_chunks
+        original_titles = self._scan_akas(read_akas(), hashes=True)
+        changed_names = original_titles.symmetric_difference(pd.Index(snapshot['original_titles']['title']))
+        affected = changed_keys(snapshot['akas_hashes'], self.snapshot_frames['akas_hashes'])
+        titles = self._affected_akas(read_akas, affected, changed_names)
+        affected = affected.union(titles.index.unique())
+        regions, lost_region = find_regions(titles, original_titles, self._resolve)
+        del titles
+        old_stats = snapshot['region_stats']
+        old_lost = snapshot['lost_region']
+        self._set_region(
+            pd.concat([old_stats.loc[~old_stats.index.isin(affected)], regions]).sort_index(kind='stable'),
+            concat_tables([old_lost.loc[~old_lost.index.isin(affected)], lost_region], 'title.akas').sort_index(kind='stable'),
+        )
+
+        self.get_macro(macro_year)
+        ratings = self._load('title.ratings')
+        basics = self._load('title.basics')
         self.ratings_length = len(ratings)
-        basics = get_data(self.basics_path, 'imdb', 'tconst', 'title.basics')
-        basics['startYear'] = pd.to_numeric(basics['startYear'], errors='coerce')
         self.basics_length = len(basics)
-        self.titles = self.region.join([ratings, basics], how='left')
-        self.titles = pd.merge(self.titles, self.macro_data, left_on='region', right_index=True, how='left')
-        self.titles = self.titles.replace({'\\N': np.NaN})
-        self.titles_length = len(self.titles)
-        self.titles = self.titles.dropna(subset=['startYear']).loc[lambda x: (x['startYear'] >= self.start_year) & (x['startYear'] <= self.end_year)].copy()
+        self.snapshot_frames['ratings_hashes'] = key_hashes(ratings)
+        self.snapshot_frames['basics_hashes'] = key_hashes(basics)
+        rejoin = affected.union(changed_keys(snapshot['ratings_hashes'], self.snapshot_frames['ratings_hashes'])).union(
+            changed_keys(snapshot['basics_hashes'], self.snapshot_frames['basics_hashes'])
+        )
+        joined = self._join(self.region.loc[self.region.index.isin(rejoin)], ratings, basics)
+        self.titles_length = len(self.region)
+
+        update_year_store(directory, joined.dropna(subset=['startYear']), rejoin, {
+            'key': key,
+            'counters': {counter: getattr(self, counter) for counter in STORE_COUNTERS},
+        })
+        save_snapshot(directory, {'region_stats': self.region_stats, 'lost_region': self.lost_region, **self.snapshot_frames})
+        self.year_store = YearStore(directory)
+        print(f'Store refreshed: {len(affected)} titles resolved and {len(rejoin)} titles joined again.')
+        return True
+
+    def _affected_akas(self, read_akas, changed, changed_names):
+        # Rows of title.akas of the changed titles and of the titles with a translation matching a changed
+        # original title. Rows of the latter in earlier chunks are skipped before the match is seen, so
+        # with more than one chunk a second pass gathers all their rows.
+        rows, matched = [], []
+        for chunk in read_akas():
+            is_translation = (chunk.isOriginalTitle == 0).to_numpy(dtype=bool, na_value=False)
+            matched.append(chunk.index[chunk['title'].isin(changed_names).to_numpy() & is_translation])
+            rows.append(chunk.loc[chunk.index.isin(changed.union(matched[-1]))])
+        matched = pd.Index([]).append(matched).unique().difference(changed)
+        if len(rows) > 1 and len(matched):
+            rows = [chunk.loc[chunk.index.isin(changed.union(matched))] for chunk in read_akas()]
+        # Chunks have categories of their own, which concat turns into plain values.
+        return concat_tables(rows, 'title.akas').astype({'region': 'category', 'language': 'category'})
+
+    def check_consistency(self):
+        # Compares the current region resolution and titles store with a full rebuild from the inputs.
+        full = Data(
+            self.titles_akas_path, self.gdp_path, self.population_path, self.mapping_path, self.ratings_path,
+            self.basics_path, self.start_year, self.end_year, self.include_world, join_backend=self.join_backend,
+        )
+        full.get_region()
+        full.get_macro(self.macro_year)
+        checks = {
+            'region': canonical(self.region).equals(canonical(full.region)),
+            'lost_region': canonical(self.lost_region).equals(canonical(full.lost_region)),
+            'titles': canonical(self.year_store.to_pandas()).equals(canonical(full.join_all_years())),
+        }
+        checks.update({counter: getattr(self, counter) == getattr(full, counter) for counter in STORE_COUNTERS})
+        for name, consistent in checks.items():
+            if not consistent:
+                print(f'Inconsistent with a full rebuild: {name}')
+        return all(checks.values())
+
+    def load_year_store(self, directory, macro_year='2022'):
+        # Uses a store built from the same input files and options, returns False if there is none.
+        metadata = read_store_metadata(directory)
+        try:
+            if metadata is None or metadata['key'] != self._store_key(macro_year):
+                return False
+        except OSError:
+            return False
+        self.macro_year = int(macro_year)
+        with self.recorder.stage('load_year_store') as stage:
+            self.year_store = YearStore(directory)
+            stage['rows_out'] = len(self.year_store)
+        for counter, value in metadata['counters'].items():
+            setattr(self, counter, value)
+        return True
+
+    def select_years(self, start_year, end_year):
+        if end_year < start_year:
+            print(f'End date smaller than start date. Performing analysis for {start_year} only.')
+            end_year = start_year
+        self.start_year = start_year
+        self.end_year = end_year
+        with self.recorder.stage('select_years') as stage:
+            if hasattr(self, 'year_store'):
+                self.titles = self.year_store.slice(start_year, end_year)
+            else:
+                if not hasattr(self, 'all_titles'):
+                    self.all_titles = self.join_all_years()
+                self.titles = self.all_titles.loc[lambda x: (x['startYear'] >= start_year) & (x['startYear'] <= end_year)].copy()
+            stage['rows_out'] = len(self.titles)
         return self.titles
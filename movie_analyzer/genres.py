@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+# Genres of title.basics. Each has a fixed bit in the uint32 genreMask column of the joined titles;
+# genres outside this list get no bit.
+GENRES = [
+    'Action', 'Adult', 'Adventure', 'Animation', 'Biography', 'Comedy', 'Crime', 'Documentary', 'Drama',
+    'Family', 'Fantasy', 'Film-Noir', 'Game-Show', 'History', 'Horror', 'Music', 'Musical', 'Mystery',
+    'News', 'Reality-TV', 'Romance', 'Sci-Fi', 'Short', 'Sport', 'Talk-Show', 'Thriller', 'War', 'Western',
+]
+GENRE_BITS = {genre: 1 << bit for bit, genre in enumerate(GENRES)}
+
+
+def genre_mask(genres):
+    # Bits of one or more genres, e.g. genre_mask(['Comedy', 'Drama']).
+    genres = [genres] if isinstance(genres, str) else genres
+    mask = 0
+    for genre in genres:
+        if genre not in GENRE_BITS:
+            raise ValueError(f'Unknown genre {genre}')
+        mask |= GENRE_BITS[genre]
+    return np.uint32(mask)
+
+
+def genre_masks(genres):
+    # Bitmask of every row of a column of comma separated genres, 0 where genres are missing.
+    # Each distinct list is parsed once and the rows take the mask of their list.
+    if not isinstance(genres.dtype, pd.CategoricalDtype):
+        genres = genres.astype('category')
+    masks = [sum(GENRE_BITS.get(genre, 0) for genre in value.split(',')) for value in genres.cat.categories]
+    return np.array(masks + [0], dtype=np.uint32)[genres.cat.codes.to_numpy()]
+
+
+def fill_genre_masks(titles):
+    # A left join leaves the titles without a title.basics row with a missing, float genreMask;
+    # they have no genres, so their mask is 0 and the column stays uint32.
+    if 'genreMask' in titles.columns and titles['genreMask'].dtype != np.uint32:
+        titles['genreMask'] = titles['genreMask'].fillna(0).astype(np.uint32)
+    return titles
+
+
+def has_genres(masks, all_of=(), any_of=()):
+    # Rows that have every genre of all_of and at least one genre of any_of.
+    masks = np.asarray(masks, dtype=np.uint32)
+    selected = np.ones(len(masks), dtype=bool)
+    if len(all_of) > 0:
+        mask = genre_mask(all_of)
+        selected &= (masks & mask) == mask
+    if len(any_of) > 0:
+        selected &= (masks & genre_mask(any_of)) != 0
+    return selected
+
+
+def explode_genres(masks):
+    # Row positions and genre (index in GENRES) of every (row, genre) pair, ordered by genre then row.
+    masks = np.asarray(masks, dtype=np.uint32)
+    rows = [np.flatnonzero(masks & np.uint32(bit)) for bit in GENRE_BITS.values()]
+    genres = np.repeat(np.arange(len(GENRES)), [len(r) for r in rows])
+    return np.concatenate(rows), genres
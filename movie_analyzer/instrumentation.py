@@ -0,0 +1,142 @@
+import cProfile
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak_rss_mb is then left empty.
+    resource = None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _proc_status_mb(field, pid='self'):
+    # VmRSS (current) or VmHWM (peak since the last reset_peak_rss) of a process from /proc, None outside
+    # Linux or when the process is gone.
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return None
+
+
+def rss_mb():
+    return _proc_status_mb('VmRSS')
+
+
+def peak_rss_since_reset_mb(pid='self'):
+    return _proc_status_mb('VmHWM', pid)
+
+
+def reset_peak_rss(pid='self'):
+    # Resets VmHWM of a process to its current RSS, so the next peak is that of the code that runs from now on.
+    # ru_maxrss is not affected. Returns False where this is not supported.
+    try:
+        with open(f'/proc/{pid}/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageRecorder:
+    # Wall time, CPU time, memory and rows in and out of every stage of a run.
+    # With profile_dir set, each top-level stage is also profiled with cProfile into its own file.
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.stages = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Peak RSS so far of every open stage. VmHWM is reset whenever a stage starts, so its value up to
+        # then is first folded into the stages that are already open.
+        self._peaks = {}
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+        # Yields the record of the stage, so the caller can set rows_out (or rows_in once it is known).
+        # Stages may be nested; the CPU time is that of the whole process. rss_delta_mb is the change of
+        # RSS over the stage. peak_rss_mb is the peak RSS during the stage, nested stages included, and is
+        # left empty where the peak cannot be reset.
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        with self._lock:
+            peak = peak_rss_since_reset_mb()
+            measure_peak = reset_peak_rss()
+            if measure_peak:
+                self._fold_peak(peak)
+                self._peaks[id(record)] = 0.0
+        start_rss = rss_mb()
+        # Only one profiler can be active in a thread, so nested stages show up in their parent's profile.
+        profiler = cProfile.Profile() if self.profile_dir is not None and depth == 0 else None
+        start, start_cpu = time.perf_counter(), time.process_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['seconds'] = time.perf_counter() - start
+            record['cpu_seconds'] = time.process_time() - start_cpu
+            end_rss = rss_mb()
+            record['rss_start_mb'] = start_rss
+            record['rss_end_mb'] = end_rss
+            record['rss_delta_mb'] = None if start_rss is None else end_rss - start_rss
+            record['peak_rss_mb'] = None
+            record['depth'] = depth
+            self._local.depth = depth
+            with self._lock:
+                if measure_peak:
+                    self._fold_peak(peak_rss_since_reset_mb())
+                    record['peak_rss_mb'] = self._peaks.pop(id(record))
+                if profiler is not None:
+                    os.makedirs(self.profile_dir, exist_ok=True)
+                    record['profile'] = os.path.join(self.profile_dir, f'{len(self.stages):03d}_{name}.pstats')
+                    profiler.dump_stats(record['profile'])
+                self.stages.append(record)
+
+    def _fold_peak(self, peak):
+        for key, value in self._peaks.items():
+            self._peaks[key] = max(value, peak)
+
+    def add(self, name, seconds, rows_in=None, rows_out=None):
+        # Stages that ran elsewhere (e.g. files loaded by a background pool) and only report their time.
+        with self._lock:
+            self.stages.append({
+                'stage': name, 'rows_in': rows_in, 'rows_out': rows_out, 'seconds': seconds,
+                'cpu_seconds': None, 'rss_start_mb': None, 'rss_end_mb': None, 'rss_delta_mb': None,
+                'peak_rss_mb': None, 'depth': getattr(self._local, 'depth', 0),
+            })
+
+    def write_manifest(self, path, **info):
+        manifest = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'peak_rss_mb': peak_rss_mb(),
+            **info,
+            'stages': self.stages,
+        }
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=2, default=str)
+            print(f'The run manifest has been saved to {path}')
+        except Exception as e:
+            print(f'Issues while saving the run manifest: {e}')
+        return manifest
@@ -1,11 +1,22 @@
 import argparse
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-from data import Data
-import matplotlib.pyplot as plt
-from IPython.display import display, HTML
-
-def main(args):
+from arrow_engine import ENGINES
+from data import Data, STORE_COUNTERS
+from instrumentation import StageRecorder
+from cache import DEFAULT_CACHE_DIR, clear_cache
+from report import OUTPUT_FORMATS, Report, use_agg_backend
+from server import AnalysisServer
+from sharding import ShardPool
+
+def load(args):
+    start_year, end_year = args.year_ranges[0] if args.year_ranges else (args.start_year, args.end_year)
+    if start_year is None or end_year is None:
+        # The server answers queries for any year range.
+        start_year, end_year = 0, 9999
     test = Data(
         args.title_akas,
         args.gdp,
@@ -13,187 +24,147 @@ def main(args):
         args.mapping,
         args.title_ratings,
         args.title_basics,
-        args.start_year,
-        args.end_year,
+        start_year,
+        end_year,
         args.world,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        chunksize=args.chunksize,
+        join_backend=args.join_backend,
+        engine=args.engine,
+        workers=args.workers,
+        prefetch_pool=args.prefetch_pool,
+        recorder=StageRecorder(args.profile_dir if args.profile else None),
+        shard_pool=ShardPool(args.shards) if args.shards else None,
+        snapshot=args.refresh,
     )
 
-    test.get_region()
-    test.get_macro(str(args.macro_year))
-    test.join_data()
-
-    # Task 1
-    # In this task we get the best movies that have more than 10k votes on imdb and find the best regions.
-    best_movies_5 = (
-        test.titles.loc[lambda x: (x['numVotes'] > 10_000) & (x['titleType'].isin(['movie']))]
-        .groupby('regionName')['averageRating']
-        .apply(lambda x: x.nlargest(5).mean())
-        .sort_values()
-    )
-    best_movies_10 = (
-        test.titles.loc[lambda x: (x['numVotes'] > 10_000) & (x['titleType'].isin(['movie']))]
-        .groupby('regionName')['averageRating']
-        .apply(lambda x: x.nlargest(10).mean())
-        .sort_values()
-    )
-    best_movies_20 = (
-        test.titles.loc[lambda x: (x['numVotes'] > 10_000) & (x['titleType'].isin(['movie']))]
-        .groupby('regionName')['averageRating']
-        .apply(lambda x: x.nlargest(20).mean())
-        .sort_values()
-    )
-
-    # Task 2
-    # In this task we utilize the ranking of movies from task 1. We compare the movies ranking, total number of votes 
-    # with the ranking of GDP, population and GDP per capita
-
-    ranking = test.titles.groupby('regionName').agg({
-        'gdp': 'mean', 
-        'population': 'mean', 
-        'gdp_pc': 'mean', 
-        'numVotes': 'sum',
-    })
-    ranking = ranking.join(best_movies_5).dropna()
-    ranking = ranking.rank(ascending=False)
-
-    ranking['weak_impact_gdp'] = ranking['gdp'] - ranking['numVotes']
-    ranking['weak_impact_population'] = ranking['population'] - ranking['numVotes']
-    ranking['weak_impact_gdp_pc'] = ranking['gdp_pc'] - ranking['numVotes']
-
-    ranking['strong_impact_gdp'] = ranking['gdp'] - ranking['averageRating']
-    ranking['strong_impact_population'] = ranking['population'] - ranking['averageRating']
-    ranking['strong_impact_gdp_pc'] = ranking['gdp_pc'] - ranking['averageRating']
-
-    # Task 3
-    # In this task we try to analyze how the polish movies changed through the years
-    # We try to find the answer to question whether polsih movies become worse as the time progresses
-    # At the same time, we verify if the comedies become any better
+    # The joined titles of all years are kept in the cache, so the loading, region resolution and
+    # joins only run when an input file or option changed.
+    store_dir = None if args.no_cache else os.path.join(args.cache_dir, 'titles_store')
+    if store_dir is None or not test.load_year_store(store_dir, args.macro_year):
+        if args.refresh and store_dir is not None and test.refresh(store_dir, args.macro_year):
+            if args.check_refresh and not test.check_consistency():
+                print('The refreshed store differs from a full rebuild. Rebuild it with --clear_cache.')
+            return test
+        if args.prefetch:
+            test.load_all()
+        test.get_region()
+        test.get_macro(str(args.macro_year))
+        if store_dir is not None:
+            test.build_year_store(store_dir)
+    return test
 
-    polish_movies = test.titles.loc[
-        lambda x: (x['regionName'] == 'Poland') & (x['titleType'] == 'movie') & (x['numVotes'] > 3_000)
-    ].copy()
-    polish_comedies = polish_movies.dropna(subset=['genres'])
-    polish_comedies = polish_comedies.loc[polish_comedies.genres.str.contains('Comedy')].copy()
-
-    fig, axes = plt.subplots(2, 1, figsize=(10, 6))
-
-    if len(polish_movies) > 0:
-        (polish_movies.groupby('startYear')[['averageRating']]
-        .agg([lambda x: x.nlargest(5).mean()])
-        .plot(ax=axes[0], title='Average rating of five best movies from each year', legend=False)).set_xlabel('Year')
-    else:
-        axes[0].text(0.5, 0.5, 'No data', fontsize=20, ha='center')
-        axes[0].set_title('Average rating of five best movies from each year')
-    if len(polish_comedies) > 0:
-        (polish_comedies.groupby('startYear')[['averageRating']]
-        .agg([lambda x: x.mean()])
-        .plot(ax=axes[1], title='Average rating of comedies from each year', legend=False)).set_xlabel('Year')
+def main(args):
+    if args.clear_cache:
+        clear_cache(args.cache_dir)
+
+    test = load(args)
+    if args.serve:
+        store_dir = None if args.no_cache else os.path.join(args.cache_dir, 'titles_store')
+        server = AnalysisServer(test, workers=args.server_workers, pool=args.server_pool, store_dir=store_dir)
+        if test.shard_pool is not None:
+            test.shard_pool.close()
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            print('Server stopped.')
+        return
+
+    pool = None
+    if 'html' in args.output_format and args.plot_workers != 0:
+        pool = ProcessPoolExecutor(max_workers=args.plot_workers, initializer=use_agg_backend)
+    plots = []
+    if args.year_ranges:
+        for start_year, end_year in args.year_ranges:
+            test.select_years(start_year, end_year)
+            suffix = f'_{start_year}_{end_year}'
+            plots.append((suffix, report(test, args.output_format, suffix, interactive=False, pool=pool)[1]))
     else:
-        axes[1].text(0.5, 0.5, 'No data', fontsize=20, ha='center')
-        axes[1].set_title('Average rating of comedies from each year')
-
-    plt.tight_layout()
-    plt.savefig('polish_movies_analysis.png')
-    plt.close()
-
-    html_output = f"""
-    <h1>Assumptions used for the analysis</h1>
-    <p>
-        Certain countries are joined as regions. These are English speaking region, Spanish speaking region,
-        German speaking region, Portuguese speaking region. 
-        If for some movie, the country of origin was not to be found, it was categorised as international production. 
-        If you do not want to see this region in analysis, use flag --world=False. For different year of macro data use flag --macro_year.
-    </p>
-    <h1>Data handling</h1>
-    <p>
-    The original title.akas table had {test.akas_length} rows with {test.unique_movies_length} unique movies. After processing, {test.found_region_length} movie titles were given a region. The others
-    are assumed to be international production and have flag 'World' if --world=True. Table title.basics have {test.basics_length} rows and title.ratings have {test.ratings_length} rows.
-    After joining all the necessary tables we get {test.titles_length}. rows for the analysis. Below w show the columns with the most NaN values.
-    As we can see most movies do not have a rating, so they are left outside the analysis.
-    </p>
-    {test.titles.isna().mean().sort_values().to_html()}
-    <h1>Best Movies by Region</h1>
-
-    <h2>Top 5 movies from each region<h2>
-    {best_movies_5.tail(20).to_frame().round(2).to_html()}
-    <h2>Top 10 movies from each region<h2>
-    {best_movies_10.tail(20).to_frame().round(2).to_html()}
-    <h2>Top 20 movies from each region<h2>
-    {best_movies_20.tail(20).to_frame().round(2).to_html()}
-    
-    <h1>Best Movie Makers by Weak Impact</h1>
-    <h2>Vs GDP<h2>
-    {ranking.sort_values('weak_impact_gdp')[-5:][['weak_impact_gdp', 'numVotes', 'gdp']].round(2).to_html()}
-    <h2>Vs Population<h2>
-    {ranking.sort_values('weak_impact_population')[-5:][['weak_impact_population', 'numVotes', 'population']].to_html()}
-    <h2>Vs GDP per capita<h2>
-    {ranking.sort_values('weak_impact_gdp_pc')[-5:][['weak_impact_gdp_pc', 'numVotes', 'gdp_pc']].to_html()}
-    
-    <h1>Best Movie Makers by Strong Impact (higher place is worse)</h1>
-    <h2>Vs GDP<h2>
-    {ranking.sort_values('strong_impact_gdp')[-5:][['strong_impact_gdp', 'averageRating', 'gdp']].to_html()}
-    <h2>Vs Population<h2>
-    {ranking.sort_values('strong_impact_population')[-5:][['strong_impact_population', 'averageRating', 'population']].to_html()}
-    <h2>Vs GDP per capita<h2>
-    {ranking.sort_values('strong_impact_gdp')[-5:][['strong_impact_gdp_pc', 'averageRating', 'gdp_pc']].to_html()}
+        test.select_years(args.start_year, args.end_year)
+        plots.append(('', report(test, args.output_format, pool=pool)[1]))
+    if pool is not None:
+        for suffix, future in plots:
+            try:
+                test.recorder.add(f'plots{suffix}', future.result())
+            except Exception as e:
+                print(f'Issues while saving the plots: {e}')
+        pool.shutdown()
+    if test.shard_pool is not None:
+        test.shard_pool.close()
+
+    test.recorder.write_manifest(
+        args.manifest,
+        arguments=vars(args),
+        counters={counter: getattr(test, counter, None) for counter in STORE_COUNTERS},
+    )
 
-    <h1>Polish Movies Analysis</h1>
-    <img src="polish_movies_analysis.png" alt="Polish Movies Analysis">
-    """
+def report(test, formats=('html',), suffix='', interactive=True, pool=None):
+    # Every output is rendered from the same Report, so each result is computed once. The image
+    # is rendered in the plot pool when given; the future of its time is returned with the report.
+    results = Report(test, suffix)
+    plots = results.save_plots(pool) if 'html' in formats else None
+    for output_format in formats:
+        with test.recorder.stage(f'{output_format}{suffix}'):
+            try:
+                path = results.save(output_format)
+                print(f'The results have been saved successfully. You can find them as {path}')
+            except Exception as e:
+                print(f'Issues while saving to {output_format}: {e}')
+
+    if interactive:
+        view_results = input('Do you want to view the results in the command line? (Y/N)')
+        if view_results.upper() == 'Y':
+            results.show()
+    return results, plots
+
+def year_range(value):
+    start_year, _, end_year = value.partition('-')
     try:
-        with open('results.html', 'w') as f:
-            f.write(html_output)
-        print('The results have been saved successfully. You can find them as results.html. The plots are saved as polish_movies_analysis.png')
-    except Exception as e:
-        print(f'Issues while saving to html: {e}')
-    
-    view_results = input('Do you want to view the results in the command line? (Y/N)')
-    if view_results.upper() == 'Y':
-        print('Best regions by top 5, 10, 20 movies')
-        display(best_movies_5.tail(20).to_frame().round(2))
-        display(best_movies_10.tail(20).to_frame().round(2))
-        display(best_movies_20.tail(20).to_frame().round(2))
-        print('Countries with the strongest weak impact vs gdp, population, gdp per capita')
-        display(ranking.sort_values('weak_impact_gdp')[-5:][['weak_impact_gdp']].round(2))
-        display(ranking.sort_values('weak_impact_population')[-5:][['weak_impact_population']].round(2))
-        display(ranking.sort_values('weak_impact_gdp_pc')[-5:][['weak_impact_gdp_pc']].round(2))
-        print('Countries with the strongest strong impact vs gdp, population, gdp per capita')
-        display(ranking.sort_values('strong_impact_gdp')[-5:][['strong_impact_gdp']].round(2))
-        display(ranking.sort_values('strong_impact_population')[-5:][['strong_impact_population']].round(2))
-        display(ranking.sort_values('strong_impact_gdp_pc')[-5:][['strong_impact_gdp_pc']].round(2))
-        
-        fig, axes = plt.subplots(2, 1, figsize=(10, 6))
-
-        if len(polish_movies) > 0:
-            (polish_movies.groupby('startYear')[['averageRating']]
-            .agg([lambda x: x.nlargest(5).mean()])
-            .plot(ax=axes[0], title='Average rating of five best movies from each year'))
-        else:
-            axes[0].text(0.5, 0.5, 'No data', fontsize=20, ha='center')
-            axes[0].set_title('Average rating of five best movies from each year')
-        if len(polish_comedies) > 0:
-            (polish_comedies.groupby('startYear')[['averageRating']]
-            .agg([lambda x: x.mean()])
-            .plot(ax=axes[1], title='Average rating of comedies from each year'))
-        else:
-            axes[1].text(0.5, 0.5, 'No data', fontsize=20, ha='center')
-            axes[1].set_title('Average rating of five best comedies from each year')
-
-        plt.tight_layout()
-        plt.show()
+        return int(start_year), int(end_year or start_year)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a year range like 1990-1999')
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Analyze movie data")
-    parser.add_argument('--title_akas', type=str, required=True, help='Path to title.akas.tsv')
-    parser.add_argument('--title_ratings', type=str, required=True, help='Path to title.ratings.tsv')
-    parser.add_argument('--title_basics', type=str, required=True, help='Path to title.basics.tsv')
-    parser.add_argument('--start_year', type=int, required=True, help='Starting year')
-    parser.add_argument('--end_year', type=int, required=True, help='Ending year')
+    parser.add_argument('--title_akas', type=str, required=True, help='Path to title.akas.tsv, or title.akas.tsv.gz read without decompressing it to disk')
+    parser.add_argument('--title_ratings', type=str, required=True, help='Path to title.ratings.tsv, or title.ratings.tsv.gz read without decompressing it to disk')
+    parser.add_argument('--title_basics', type=str, required=True, help='Path to title.basics.tsv, or title.basics.tsv.gz read without decompressing it to disk')
+    parser.add_argument('--start_year', type=int, help='Starting year')
+    parser.add_argument('--end_year', type=int, help='Ending year')
+    parser.add_argument('--year_ranges', type=year_range, nargs='+', help='Produce a report for each of the year ranges, e.g. 1990-1999 2000-2009')
     parser.add_argument('--gdp', type=str, default='World_Bank_Data/gdp.csv', help='Path to gdp file')
     parser.add_argument('--population', type=str, default='World_Bank_Data/population.csv', help='Path to population file')
     parser.add_argument('--mapping', type=str, default='World_Bank_Data/code_mapping.csv', help='Path to mapping')
     parser.add_argument('--world', type=bool, default=True, help='Flag for including world region')
     parser.add_argument('--macro_year', type=int, default=2022, help='Year for the macro  data (GDP and population)')
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR, help='Directory for the cache of parsed input files')
+    parser.add_argument('--no_cache', action='store_true', help='Always parse the input files, do not read or write the cache')
+    parser.add_argument('--chunksize', type=int, default=None, help='Stream title.akas in blocks of this many rows to bound memory usage')
+    parser.add_argument('--join_backend', type=str, default='pandas', choices=['pandas', 'numpy'], help='Join titles on string indexes (pandas) or on integer title keys (numpy)')
+    parser.add_argument('--engine', type=str, default='pandas', choices=ENGINES, help='Parse the IMDb files and join the titles with pandas or with pyarrow')
+    parser.add_argument('--shards', type=int, default=None, help='Resolve regions and join titles in this many processes, each with a shard of the titles')
+    parser.add_argument('--prefetch', action='store_true', help='Load all input files concurrently at start-up')
+    parser.add_argument('--workers', type=int, default=None, help='Number of workers used for concurrent loading')
+    parser.add_argument('--prefetch_pool', type=str, default='thread', choices=['thread', 'process'], help='Pool used by --prefetch')
+    parser.add_argument('--refresh', action='store_true', help='Update the stored titles incrementally when only the IMDb dumps changed')
+    parser.add_argument('--check_refresh', action='store_true', help='After --refresh, compare the updated store with a full rebuild')
+    parser.add_argument('--clear_cache', action='store_true', help='Remove the cache of parsed input files before the run')
+    parser.add_argument('--output_format', type=str, nargs='+', default=['html'], choices=OUTPUT_FORMATS, help='Formats of the results, html also renders the plots')
+    parser.add_argument('--plot_workers', type=int, default=None, help='Number of processes rendering the plots, 0 renders them in the main process')
+    parser.add_argument('--serve', action='store_true', help='Keep the joined titles in memory and answer queries over a local HTTP/JSON API')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the server listens on')
+    parser.add_argument('--port', type=int, default=8000, help='Port the server listens on')
+    parser.add_argument('--server_workers', type=int, default=None, help='Number of workers answering queries')
+    parser.add_argument('--server_pool', type=str, default='thread', choices=['thread', 'process'], help='Pool answering queries, processes memory-map the titles store')
+    parser.add_argument('--manifest', type=str, default='run_manifest.json', help='Path of the json file with the timings, memory and row counts of every stage')
+    parser.add_argument('--profile', action='store_true', help='Profile every stage with cProfile')
+    parser.add_argument('--profile_dir', type=str, default='profiles', help='Directory for the .pstats files written by --profile')
 
     args = parser.parse_args()
+    if not args.serve and not args.year_ranges and (args.start_year is None or args.end_year is None):
+        parser.error('--start_year and --end_year are required unless --year_ranges is given')
+    if args.engine == 'arrow' and args.join_backend == 'numpy':
+        parser.error('--engine arrow joins the titles itself and cannot be used with --join_backend numpy')
+    if args.refresh and args.no_cache:
+        parser.error('--refresh updates the cached titles and cannot be used with --no_cache')
     main(args)
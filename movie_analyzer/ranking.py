@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+
+def top_k_means(data, by, value, ks):
+    # Mean of the k largest values of every group, for every k in ks at once.
+    # Rows are sorted once by (group, value descending); the sum of the k best values of a group
+    # is then the difference of the cumulative sum at the group offset and k rows later.
+    by = [by] if isinstance(by, str) else list(by)
+    data = data.loc[data[value].notna() & data[by].notna().all(axis=1), by + [value]]
+    grouped = data.groupby(by, sort=True, observed=True)
+    codes = grouped.ngroup().to_numpy()
+    groups = grouped.size()
+
+    values = data[value].to_numpy(dtype=np.float64)
+    order = np.lexsort((-values, codes))
+    cumsum = np.concatenate([[0.0], np.cumsum(values[order])])
+    sizes = groups.to_numpy()
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+
+    result = {}
+    for k in ks:
+        counts = np.minimum(sizes, k)
+        result[k] = (cumsum[starts + counts] - cumsum[starts]) / counts
+    return pd.DataFrame(result, index=groups.index)
@@ -0,0 +1,251 @@
+import json
+import os
+import time
+
+import matplotlib
+import matplotlib.pyplot as plt
+from IPython.display import display
+
+from data import STORE_COUNTERS
+from ranking import top_k_means
+from trends import ALL_GENRES, trend, trend_cube
+
+IMPACT_COLUMNS = [
+    'weak_impact_gdp', 'weak_impact_population', 'weak_impact_gdp_pc',
+    'strong_impact_gdp', 'strong_impact_population', 'strong_impact_gdp_pc',
+]
+OUTPUT_FORMATS = ['html', 'json', 'csv']
+
+
+def best_movies_by_region(titles):
+    # Task 1
+    # In this task we get the best movies that have more than 10k votes on imdb and find the best regions.
+    best_movies = top_k_means(
+        titles.loc[lambda x: (x['numVotes'] > 10_000) & (x['titleType'].isin(['movie']))],
+        'regionName',
+        'averageRating',
+        [5, 10, 20],
+    )
+    best_movies_5 = best_movies[5].rename('averageRating').sort_values()
+    best_movies_10 = best_movies[10].rename('averageRating').sort_values()
+    best_movies_20 = best_movies[20].rename('averageRating').sort_values()
+    return best_movies_5, best_movies_10, best_movies_20
+
+def impact_ranking(titles, best_movies_5):
+    # Task 2
+    # In this task we utilize the ranking of movies from task 1. We compare the movies ranking, total number of votes
+    # with the ranking of GDP, population and GDP per capita
+
+    ranking = titles.groupby('regionName').agg({
+        'gdp': 'mean',
+        'population': 'mean',
+        'gdp_pc': 'mean',
+        'numVotes': 'sum',
+    })
+    ranking = ranking.join(best_movies_5).dropna()
+    ranking = ranking.rank(ascending=False)
+
+    ranking['weak_impact_gdp'] = ranking['gdp'] - ranking['numVotes']
+    ranking['weak_impact_population'] = ranking['population'] - ranking['numVotes']
+    ranking['weak_impact_gdp_pc'] = ranking['gdp_pc'] - ranking['numVotes']
+
+    ranking['strong_impact_gdp'] = ranking['gdp'] - ranking['averageRating']
+    ranking['strong_impact_population'] = ranking['population'] - ranking['averageRating']
+    ranking['strong_impact_gdp_pc'] = ranking['gdp_pc'] - ranking['averageRating']
+    return ranking
+
+def polish_movies_by_year(titles):
+    # Task 3
+    # In this task we try to analyze how the polish movies changed through the years
+    # We try to find the answer to question whether polsih movies become worse as the time progresses
+    # At the same time, we verify if the comedies become any better
+    return polish_movies_from_cube(trend_cube(titles.loc[titles['regionName'] == 'Poland']))
+
+def polish_movies_from_cube(cube):
+    best_polish_movies = trend(cube, 'Poland', ALL_GENRES, 'top_5').rename('averageRating')
+    polish_comedies = trend(cube, 'Poland', 'Comedy', 'mean').rename('averageRating')
+    return best_polish_movies, polish_comedies
+
+
+def use_agg_backend():
+    # Initializer of the plot workers, which only write image files.
+    matplotlib.use('Agg', force=True)
+
+
+def plot_polish_movies(axes, best_polish_movies, polish_comedies, interactive=False):
+    if len(best_polish_movies) > 0:
+        axis = best_polish_movies.plot(ax=axes[0], title='Average rating of five best movies from each year', legend=False)
+        if not interactive:
+            axis.set_xlabel('Year')
+    else:
+        axes[0].text(0.5, 0.5, 'No data', fontsize=20, ha='center')
+        axes[0].set_title('Average rating of five best movies from each year')
+    if len(polish_comedies) > 0:
+        axis = polish_comedies.plot(ax=axes[1], title='Average rating of comedies from each year', legend=False)
+        if not interactive:
+            axis.set_xlabel('Year')
+    else:
+        axes[1].text(0.5, 0.5, 'No data', fontsize=20, ha='center')
+        axes[1].set_title('Average rating of five best comedies from each year' if interactive else 'Average rating of comedies from each year')
+
+
+def save_plots(best_polish_movies, polish_comedies, path):
+    # Runs in the plot workers as well, so it only takes the series it draws and returns its time.
+    start = time.perf_counter()
+    fig, axes = plt.subplots(2, 1, figsize=(10, 6))
+    plot_polish_movies(axes, best_polish_movies, polish_comedies)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close(fig)
+    return time.perf_counter() - start
+
+
+class Report:
+    # Named results of the analysis of data.titles. Each artifact is computed once, on first use,
+    # and shared by the html, json, csv, image and console outputs.
+    def __init__(self, data, suffix=''):
+        self.data = data
+        self.titles = data.titles
+        self.suffix = suffix
+        self.recorder = data.recorder
+        self.artifacts = {}
+
+    def __getitem__(self, name):
+        if name not in self.artifacts:
+            with self.recorder.stage(f'{name}{self.suffix}', rows_in=len(self.titles)) as stage:
+                if name in IMPACT_COLUMNS:
+                    self.artifacts[name] = self['ranking'].sort_values(name)[-5:]
+                else:
+                    self.artifacts[name] = getattr(self, '_' + name)()
+                stage['rows_out'] = len(self.artifacts[name])
+        return self.artifacts[name]
+
+    def _best_movies(self):
+        return dict(zip([5, 10, 20], best_movies_by_region(self.titles)))
+
+    def _ranking(self):
+        return impact_ranking(self.titles, self['best_movies'][5])
+
+    def _trends(self):
+        return trend_cube(self.titles)
+
+    def _polish_movies(self):
+        return polish_movies_from_cube(self['trends'])
+
+    def _missing_values(self):
+        # genreMask is derived from genres and never missing.
+        return self.titles.drop(columns='genreMask', errors='ignore').isna().mean().sort_values()
+
+    def tables(self):
+        # Full tables of every artifact for the json and csv outputs.
+        best_polish_movies, polish_comedies = self['polish_movies']
+        tables = {'missing_values': self['missing_values'].rename('share').to_frame()}
+        for k, best_movies in self['best_movies'].items():
+            tables[f'best_movies_{k}'] = best_movies.to_frame()
+        tables['impact_ranking'] = self['ranking']
+        tables['best_polish_movies'] = best_polish_movies.to_frame()
+        tables['polish_comedies'] = polish_comedies.to_frame()
+        tables['trends'] = self['trends']
+        return tables
+
+    def image_path(self):
+        return f'polish_movies_analysis{self.suffix}.png'
+
+    def save_plots(self, pool=None):
+        # Renders the image in the pool if given and returns the future, otherwise renders it here.
+        best_polish_movies, polish_comedies = self['polish_movies']
+        if pool is not None:
+            return pool.submit(save_plots, best_polish_movies, polish_comedies, self.image_path())
+        with self.recorder.stage(f'plots{self.suffix}'):
+            save_plots(best_polish_movies, polish_comedies, self.image_path())
+
+    def to_html(self):
+        test = self.data
+        best_movies = self['best_movies']
+        return f"""
+    <h1>Assumptions used for the analysis</h1>
+    <p>
+        Certain countries are joined as regions. These are English speaking region, Spanish speaking region,
+        German speaking region, Portuguese speaking region.
+        If for some movie, the country of origin was not to be found, it was categorised as international production.
+        If you do not want to see this region in analysis, use flag --world=False. For different year of macro data use flag --macro_year.
+    </p>
+    <h1>Data handling</h1>
+    <p>
+    The original title.akas table had {test.akas_length} rows with {test.unique_movies_length} unique movies. After processing, {test.found_region_length} movie titles were given a region. The others
+    are assumed to be international production and have flag 'World' if --world=True. Table title.basics have {test.basics_length} rows and title.ratings have {test.ratings_length} rows.
+    After joining all the necessary tables we get {test.titles_length}. rows for the analysis. Below w show the columns with the most NaN values.
+    As we can see most movies do not have a rating, so they are left outside the analysis.
+    </p>
+    {self['missing_values'].to_frame().to_html()}
+    <h1>Best Movies by Region</h1>
+
+    <h2>Top 5 movies from each region<h2>
+    {best_movies[5].tail(20).to_frame().round(2).to_html()}
+    <h2>Top 10 movies from each region<h2>
+    {best_movies[10].tail(20).to_frame().round(2).to_html()}
+    <h2>Top 20 movies from each region<h2>
+    {best_movies[20].tail(20).to_frame().round(2).to_html()}
+
+    <h1>Best Movie Makers by Weak Impact</h1>
+    <h2>Vs GDP<h2>
+    {self['weak_impact_gdp'][['weak_impact_gdp', 'numVotes', 'gdp']].round(2).to_html()}
+    <h2>Vs Population<h2>
+    {self['weak_impact_population'][['weak_impact_population', 'numVotes', 'population']].to_html()}
+    <h2>Vs GDP per capita<h2>
+    {self['weak_impact_gdp_pc'][['weak_impact_gdp_pc', 'numVotes', 'gdp_pc']].to_html()}
+
+    <h1>Best Movie Makers by Strong Impact (higher place is worse)</h1>
+    <h2>Vs GDP<h2>
+    {self['strong_impact_gdp'][['strong_impact_gdp', 'averageRating', 'gdp']].to_html()}
+    <h2>Vs Population<h2>
+    {self['strong_impact_population'][['strong_impact_population', 'averageRating', 'population']].to_html()}
+    <h2>Vs GDP per capita<h2>
+    {self['strong_impact_gdp'][['strong_impact_gdp_pc', 'averageRating', 'gdp_pc']].to_html()}
+
+    <h1>Polish Movies Analysis</h1>
+    <img src="{self.image_path()}" alt="Polish Movies Analysis">
+    """
+
+    def save(self, output_format):
+        if output_format == 'html':
+            path = f'results{self.suffix}.html'
+            with open(path, 'w') as f:
+                f.write(self.to_html())
+            return f'{path}. The plots are saved as {self.image_path()}'
+        if output_format == 'json':
+            path = f'results{self.suffix}.json'
+            output = {
+                'start_year': self.data.start_year,
+                'end_year': self.data.end_year,
+                'counters': {counter: getattr(self.data, counter, None) for counter in STORE_COUNTERS},
+                'tables': {name: json.loads(table.to_json(orient='split')) for name, table in self.tables().items()},
+            }
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(output, f, indent=2)
+            return path
+        path = f'results{self.suffix}'
+        os.makedirs(path, exist_ok=True)
+        for name, table in self.tables().items():
+            table.to_csv(os.path.join(path, name + '.csv'))
+        return f'{path}/*.csv'
+
+    def show(self):
+        best_movies = self['best_movies']
+        print('Best regions by top 5, 10, 20 movies')
+        display(best_movies[5].tail(20).to_frame().round(2))
+        display(best_movies[10].tail(20).to_frame().round(2))
+        display(best_movies[20].tail(20).to_frame().round(2))
+        print('Countries with the strongest weak impact vs gdp, population, gdp per capita')
+        display(self['weak_impact_gdp'][['weak_impact_gdp']].round(2))
+        display(self['weak_impact_population'][['weak_impact_population']].round(2))
+        display(self['weak_impact_gdp_pc'][['weak_impact_gdp_pc']].round(2))
+        print('Countries with the strongest strong impact vs gdp, population, gdp per capita')
+        display(self['strong_impact_gdp'][['strong_impact_gdp']].round(2))
+        display(self['strong_impact_population'][['strong_impact_population']].round(2))
+        display(self['strong_impact_gdp_pc'][['strong_impact_gdp_pc']].round(2))
+
+        fig, axes = plt.subplots(2, 1, figsize=(10, 6))
+        plot_polish_movies(axes, *self['polish_movies'], interactive=True)
+        plt.tight_layout()
+        plt.show()
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import signal
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import parse_qs, urlsplit
+
+from report import best_movies_by_region, impact_ranking, polish_movies_by_year
+from genres import has_genres
+from trends import ALL_GENRES, trend, trend_cube
+from store import YearStore
+
+# Joined titles of all years the queries run on: a YearStore, sliced from its pandas frame, or a DataFrame
+# when there is no store. Worker processes open the store themselves in _init_worker.
+_titles = None
+
+STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+def _set_titles(titles):
+    global _titles
+    _titles = titles
+    # The cached cubes were built from the previous titles.
+    _trend_cube.cache_clear()
+
+
+def _init_worker(store_dir):
+    # Ctrl+C stops the server, which then shuts the pool down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    store = YearStore(store_dir)
+    # Converted to pandas once here instead of on every query.
+    store.frame()
+    _set_titles(store)
+
+
+def _select(start_year, end_year):
+    if isinstance(_titles, YearStore):
+        return _titles.frame_slice(start_year, end_year)
+    return _titles.loc[lambda x: (x['startYear'] >= start_year) & (x['startYear'] <= end_year)]
+
+
+@lru_cache(maxsize=16)
+def _trend_cube(start_year, end_year):
+    # The cube of a year range answers the trend queries of every region and genre.
+    return trend_cube(_select(start_year, end_year))
+
+
+def _genres(params, name):
+    return [genre for genre in params.get(name, '').split(',') if genre]
+
+
+def _records(frame):
+    # Plain python objects that json can serialize, with NaN as null.
+    return json.loads(frame.to_json(orient='index'))
+
+
+def _year(params, name, default):
+    try:
+        return int(params.get(name, default))
+    except ValueError:
+        raise ValueError(f'{name} must be a year, got {params[name]}')
+
+
+def run_query(path, params):
+    # Runs in the worker pool. Every query works on the titles with start_year <= startYear <= end_year.
+    start_year = _year(params, 'start_year', 0)
+    end_year = _year(params, 'end_year', 9999)
+    titles = _select(start_year, end_year)
+    # genres=Comedy,Drama keeps the titles with both genres, any_genres=Comedy,Drama those with either.
+    all_of, any_of = _genres(params, 'genres'), _genres(params, 'any_genres')
+    if path == '/trends' and (all_of or any_of):
+        # The cube is built from all titles of the year range and has a genre axis of its own.
+        raise ValueError('/trends does not take genres or any_genres, select a genre with genre=')
+    if all_of or any_of:
+        titles = titles.loc[has_genres(titles['genreMask'], all_of, any_of)]
+    if path == '/rankings':
+        # Task 1: regions by the mean rating of their k best movies.
+        k = params.get('k', '5')
+        if k not in ['5', '10', '20']:
+            raise ValueError(f'k must be 5, 10 or 20, got {k}')
+        best_movies = best_movies_by_region(titles)[['5', '10', '20'].index(k)]
+        return _records(best_movies.sort_values(ascending=False))
+    if path == '/impact':
+        # Task 2: weak and strong impact of every region.
+        return _records(impact_ranking(titles, best_movies_by_region(titles)[0]))
+    if path == '/polish':
+        # Task 3: best polish movies and comedies by year.
+        best_polish_movies, polish_comedies = polish_movies_by_year(titles)
+        return {'best_movies': _records(best_polish_movies), 'comedies': _records(polish_comedies)}
+    if path == '/trends':
+        # Yearly ratings of any (region, genre), e.g. /trends?region=Poland&genre=Comedy&column=mean.
+        column = params.get('column', 'top_5')
+        if column not in ['mean', 'count', 'top_5']:
+            raise ValueError(f'column must be mean, count or top_5, got {column}')
+        if 'region' not in params:
+            cube = _trend_cube(start_year, end_year)
+            return {'regions': sorted(cube.index.unique('regionName')), 'genres': sorted(cube.index.unique('genre'))}
+        series = trend(_trend_cube(start_year, end_year), params['region'], params.get('genre', ALL_GENRES), column)
+        return _records(series)
+    if path == '/regions':
+        summary = titles.groupby('regionName', observed=True).agg(
+            titles=('averageRating', 'size'),
+            rated=('averageRating', 'count'),
+            averageRating=('averageRating', 'mean'),
+            numVotes=('numVotes', 'sum'),
+        )
+        return _records(summary)
+    raise KeyError(path)
+
+
+class QueryCache:
+    # Results of the latest max_entries queries, keyed by (query, data version). The tasks of queries
+    # still running are cached as well, so identical concurrent requests are computed once.
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        task = asyncio.ensure_future(compute())
+        self.entries[key] = task
+        task.add_done_callback(lambda done: self._discard_failed(key, done))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return task
+
+    def _discard_failed(self, key, task):
+        if (task.cancelled() or task.exception() is not None) and self.entries.get(key) is task:
+            del self.entries[key]
+
+
+class AnalysisServer:
+    ROUTES = ['/rankings', '/impact', '/polish', '/trends', '/regions']
+
+    def __init__(self, data, workers=None, pool='thread', store_dir=None, max_entries=256):
+        # data is a Data object that has been loaded; its joined titles stay in memory for the
+        # lifetime of the server and are shared with the workers.
+        self.data = data
+        self.version = data.data_version()
+        if pool == 'process':
+            if store_dir is None:
+                raise ValueError('A process pool needs the titles store, run the server with the cache enabled.')
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(store_dir,))
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers)
+        if hasattr(data, 'year_store'):
+            _set_titles(data.year_store)
+        else:
+            if not hasattr(data, 'all_titles'):
+                data.all_titles = data.join_all_years()
+            _set_titles(data.all_titles)
+        self.titles_length = len(_titles)
+        self.cache = QueryCache(max_entries)
+
+    async def query(self, path, params):
+        params = {name: values[-1] for name, values in params.items()}
+        key = (path, tuple(sorted(params.items())), self.version)
+        loop = asyncio.get_running_loop()
+        return await self.cache.get(key, lambda: loop.run_in_executor(self.executor, run_query, path, params))
+
+    async def respond(self, method, target):
+        url = urlsplit(target)
+        if method != 'GET':
+            return 405, {'error': f'{method} is not supported'}
+        if url.path == '/health':
+            return 200, {
+                'status': 'ok', 'version': self.version, 'titles': self.titles_length,
+                'cache': {'entries': len(self.cache.entries), 'hits': self.cache.hits, 'misses': self.cache.misses},
+            }
+        if url.path not in self.ROUTES:
+            return 404, {'error': f'Unknown path {url.path}', 'paths': ['/health'] + self.ROUTES}
+        try:
+            result = await self.query(url.path, parse_qs(url.query))
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': f'{type(e).__name__}: {e}'}
+        return 200, {'version': self.version, 'result': result}
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in [b'\r\n', b'\n', b'']:
+                pass
+            if len(request_line) != 3:
+                status, body = 400, {'error': 'Malformed request'}
+            else:
+                status, body = await self.respond(request_line[0], request_line[1])
+            payload = json.dumps(body).encode('utf-8')
+            writer.write(
+                f'HTTP/1.1 {status} {STATUS[status]}\r\nContent-Type: application/json\r\n'
+                f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + payload
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8000, ready=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving the analysis on http://{host}:{server.sockets[0].getsockname()[1]} (data version {self.version})')
+        if ready is not None:
+            ready(server)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,360 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from data import (
+    key_widths, keys_identify_ids, lookup_title_keys, match_original_titles, parse_title_keys, resolve_regions,
+    take_macro_rows,
+)
+from genres import fill_genre_masks
+
+# The workers of a ShardPool get the paths of .npy and Feather files in a shared directory and memory-map
+# them, so frames are never pickled. The parent only writes the inputs and reads the results. The workers
+# compute the shard of every row and partition the rows with a counting sort, each over a range of rows,
+# so the rows of every shard end up contiguous and in their original order. Then each worker processes
+# one shard and writes its results in place into files shared by all shards.
+
+
+def _path(directory, name):
+    return os.path.join(directory, name + '.npy')
+
+
+def _load(directory, name, mode='r'):
+    return np.load(_path(directory, name), mmap_mode=mode)
+
+
+def _create(directory, name, dtype, shape):
+    # An .npy file the workers write into. Writes through shared memory maps are seen by every process
+    # mapping or reading the file, without flushing them to disk.
+    np.lib.format.open_memmap(_path(directory, name), mode='w+', dtype=dtype, shape=shape)
+
+
+def _save_strings(directory, name, values):
+    # Strings as an uncompressed Arrow array, which Arrow-backed columns are written from without conversion.
+    values = pd.Index(values)
+    values = values.array if isinstance(values.dtype, pd.StringDtype) else values.to_numpy(dtype=object)
+    array = pa.array(values, type=pa.large_string(), from_pandas=True)
+    feather.write_feather(pa.table({name: array}), os.path.join(directory, name + '.feather'), compression='uncompressed')
+
+
+def _strings(directory, name):
+    return feather.read_table(os.path.join(directory, name + '.feather'), memory_map=True).column(0)
+
+
+def _string_buffers(strings):
+    # Start and length of every string of an Arrow array and its bytes, followed by 8 zero bytes so that
+    # a 64-bit word can be read at any byte of a string.
+    _, offsets, data = strings.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[strings.offset:strings.offset + len(strings) + 1]
+    data = np.frombuffer(data, dtype=np.uint8)[offsets[0]:offsets[-1]] if data is not None else np.zeros(0, dtype=np.uint8)
+    offsets = offsets - offsets[0]
+    return offsets[:-1], np.diff(offsets), np.concatenate([data, np.zeros(8, dtype=np.uint8)])
+
+
+def _string_bytes(strings):
+    # The strings as a fixed-width bytes array, like title_bytes, without creating python strings.
+    starts, lengths, data = _string_buffers(strings)
+    width = max(int(lengths.max(initial=0)), 1)
+    columns = np.arange(width)
+    characters = np.where(columns < lengths[:, None], data[np.minimum(starts[:, None] + columns, len(data) - 1)], 0)
+    return characters.astype(np.uint8).view(f'S{width}').ravel()
+
+
+def _string_hashes(strings):
+    # Hash of every string from its length and its first and last 8 bytes, read as two 64-bit words from
+    # the Arrow buffers without creating python strings. Equal strings have equal hashes, which is all the
+    # sharding needs.
+    starts, lengths, data = _string_buffers(strings)
+    words = np.ndarray(shape=(len(data) - 7,), dtype='<u8', buffer=data, strides=(1,))
+    # Little-endian words, so the bytes within the string are the low bytes of a word.
+    shift = np.uint64(8) * np.minimum(lengths, 7).astype(np.uint64)
+    masks = np.where(lengths >= 8, np.uint64(2 ** 64 - 1), (np.uint64(1) << shift) - np.uint64(1))
+    first = words[starts] & masks
+    last = words[starts + np.maximum(lengths - 8, 0)] & masks
+    hashes = _mix(_mix(lengths.astype(np.uint64) ^ first) ^ last)
+    hashes[strings.is_null().to_numpy(zero_copy_only=False)] = 0
+    return hashes
+
+
+def _mix(hashes):
+    # The splitmix64 finalizer, so that every bit of the input changes the low bits taken by the modulo.
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def _slice(directory, name, bounds, shard):
+    return np.asarray(_load(directory, name)[bounds[shard]:bounds[shard + 1]])
+
+
+def _shards_of(keys, shards):
+    return (keys % keys.dtype.type(shards)).astype(np.int64)
+
+
+def _count_shards(directory, name, start, end, shards):
+    # Number of rows of every shard among the rows start:end of name.
+    return np.bincount(_shards_of(np.asarray(_load(directory, name)[start:end]), shards), minlength=shards)
+
+
+def _parse_keys(directory, name, start, end, shards):
+    # title_keys of the rows start:end of the ids, with key_widths of these rows.
+    ids = _strings(directory, name + '_ids').slice(start, end - start).combine_chunks()
+    keys = _load(directory, name + '_keys', 'r+')
+    range_keys, widths = parse_title_keys(_string_bytes(ids))
+    keys[start:end] = range_keys
+    return _count_shards(directory, name + '_keys', start, end, shards), key_widths(range_keys, widths)
+
+
+def _hash_titles(directory, start, end, shards):
+    # Hashes of the rows start:end of the titles. Equal titles have equal hashes, so they share a shard.
+    titles = _strings(directory, 'titles').slice(start, end - start).combine_chunks()
+    hashes = _load(directory, 'title_hashes', 'r+')
+    hashes[start:end] = _string_hashes(titles)
+    return _count_shards(directory, 'title_hashes', start, end, shards)
+
+
+def _scatter(directory, name, arrays, start, end, shards, offsets):
+    # Writes the rows start:end of the arrays into their partitioned files, the rows of every shard at the
+    # offset of the range in that shard, and their row numbers into name_rows. Shard numbers fit 16 bits,
+    # so the stable sort is a radix sort.
+    shard = _shards_of(np.asarray(_load(directory, name)[start:end]), shards).astype(np.uint16)
+    order = np.argsort(shard, kind='stable')
+    counts = np.bincount(shard, minlength=shards)
+    destination = (np.asarray(offsets) - (np.cumsum(counts) - counts))[shard[order]] + np.arange(len(order))
+    rows = _load(directory, name + '_rows', 'r+')
+    rows[destination] = start + order
+    for array in arrays:
+        output = _load(directory, array + '_parts', 'r+')
+        output[destination] = np.asarray(_load(directory, array)[start:end])[order]
+
+
+def _resolve_shard(directory, shard, bounds, n_titles, n_regions):
+    # resolve_regions for the titles of one shard, on the codes instead of the ids and regions. Shards
+    # cover disjoint titles, so their writes into the arrays of all titles never overlap.
+    title_codes = _slice(directory, 'title_codes_parts', bounds, shard)
+    region_codes = _slice(directory, 'region_codes_parts', bounds, shard)
+    regions = resolve_regions(np.arange(n_titles), title_codes, np.arange(n_regions), region_codes)
+    codes = regions.index.to_numpy(dtype=np.int64)
+    for column in ['nunique', 'last']:
+        output = _load(directory, column, 'r+')
+        output[codes] = regions[column].to_numpy()
+    present = _load(directory, 'present', 'r+')
+    present[codes] = True
+
+
+def _match_shard(directory, shard, bounds):
+    # match_original_titles for the rows of one shard, which hold every row with any of their titles.
+    # The titles are compared through the codes of an Arrow dictionary, with null as a title of its own.
+    rows = _slice(directory, 'title_hashes_rows', bounds, shard)
+    is_original = _slice(directory, 'is_original_parts', bounds, shard)
+    titles = _strings(directory, 'titles').take(rows).combine_chunks().dictionary_encode(null_encoding='encode')
+    names = titles.indices.to_numpy()
+    original_names = np.zeros(len(titles.dictionary), dtype=bool)
+    original_names[names[is_original]] = True
+    output = _load(directory, 'matches', 'r+')
+    output[rows] = original_names[names]
+
+
+def _join_shard(directory, shard, bounds, n_tables, gathers):
+    # Positions of the rows of every table matching the titles of one shard, and the values of the gathered
+    # columns at these rows, written in place into the shared files. Shards cover disjoint titles, so their
+    # writes never overlap. Equal keys share a shard, so False is returned, with nothing written, when a
+    # key repeats within a table.
+    keys = _slice(directory, 'region_keys_parts', bounds['region_keys'], shard)
+    rows = _slice(directory, 'region_keys_rows', bounds['region_keys'], shard)
+    tables = []
+    for table in range(n_tables):
+        name = f'table_{table}_keys'
+        table_keys = _slice(directory, name + '_parts', bounds[name], shard)
+        order = np.argsort(table_keys, kind='stable')
+        if (np.diff(table_keys[order]) == 0).any():
+            return False
+        tables.append((table_keys, order, _slice(directory, name + '_rows', bounds[name], shard)))
+    output = _load(directory, 'positions', 'r+')
+    for table, (table_keys, order, table_rows) in enumerate(tables):
+        positions = lookup_title_keys(table_keys[order], order, keys)
+        found = positions >= 0
+        positions[found] = table_rows[positions[found]]
+        output[table, rows] = positions
+        for column, fill in gathers[table]:
+            values = _load(directory, column)
+            gathered = np.full(len(positions), fill, dtype=values.dtype)
+            gathered[found] = values[positions[found]]
+            joined = _load(directory, 'joined_' + column, 'r+')
+            joined[rows] = gathered
+    return True
+
+
+def _column_parts(values):
+    # numpy arrays the workers gather a column from, each with its value for the titles without a row,
+    # or None for a column taken in the parent.
+    if isinstance(values, pd.Categorical):
+        return {'codes': (values.codes, -1)}
+    if isinstance(values, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+        return {'data': (values.to_numpy(values.dtype.numpy_dtype, na_value=0), 0), 'mask': (np.asarray(values.isna()), True)}
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'iuf':
+        return {'values': (values, 0)}
+    return None
+
+
+def _from_parts(values, parts, missing):
+    # The gathered column as take_rows returns it, with missing values for the titles without a row.
+    if isinstance(values, pd.Categorical):
+        return pd.Categorical.from_codes(parts['codes'], dtype=values.dtype)
+    if 'mask' in parts:
+        return type(values)(parts['data'], parts['mask'])
+    gathered = parts['values']
+    if missing.any():
+        gathered = gathered.astype(np.float64 if gathered.dtype.kind in 'iu' else gathered.dtype)
+        gathered[missing] = np.nan
+    return gathered
+
+
+class ShardPool:
+    # Runs region resolution, the original-title match and the joins by title key in a pool of workers
+    # processes, one shard each. Results are identical to resolve_regions, match_original_titles and
+    # join_titles in data.py.
+    def __init__(self, workers=None, directory=None):
+        self.shards = workers or os.cpu_count() or 1
+        self.directory = directory
+        self.executor = ProcessPoolExecutor(max_workers=self.shards)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def _run(self, function, directory, *args):
+        futures = [self.executor.submit(function, directory, shard, *args) for shard in range(self.shards)]
+        return [future.result() for future in futures]
+
+    def _ranges(self, length):
+        # One range of rows per worker for the steps that work on rows rather than shards.
+        bounds = np.linspace(0, length, self.shards + 1).astype(np.int64).tolist()
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _map_ranges(self, function, directory, names):
+        # function on every range of rows of every name, returning its results, e.g. the shard counts, of
+        # every range by name.
+        futures = {
+            name: [self.executor.submit(function, directory, name, start, end, self.shards) for start, end in self._ranges(length)]
+            for name, length in names.items()
+        }
+        return {name: [future.result() for future in name_futures] for name, name_futures in futures.items()}
+
+    def _partition(self, directory, partitions):
+        # Partitions the arrays of every name by the shard of name, given the shard counts of every range of
+        # rows, and returns the bounds of the shards in the partitioned files by name.
+        bounds = {}
+        futures = []
+        for name, (arrays, counts) in partitions.items():
+            length = len(_load(directory, name))
+            _create(directory, name + '_rows', np.int64, (length,))
+            for array in arrays:
+                _create(directory, array + '_parts', _load(directory, array).dtype, (length,))
+            shard_starts = np.concatenate([[0], np.cumsum(counts.sum(axis=0))])
+            offsets = shard_starts[:-1] + np.cumsum(counts, axis=0) - counts
+            bounds[name] = shard_starts.tolist()
+            futures += [
+                self.executor.submit(_scatter, directory, name, arrays, start, end, self.shards, range_offsets.tolist())
+                for (start, end), range_offsets in zip(self._ranges(length), offsets)
+            ]
+        for future in futures:
+            future.result()
+        return bounds
+
+    def resolve_regions(self, title_ids, title_codes, region_values, region_codes):
+        if len(title_codes) == 0:
+            return resolve_regions(title_ids, title_codes, region_values, region_codes)
+        title_ids = pd.Index(title_ids)
+        with tempfile.TemporaryDirectory(dir=self.directory) as directory:
+            np.save(_path(directory, 'title_codes'), np.asarray(title_codes, dtype=np.int64))
+            np.save(_path(directory, 'region_codes'), np.asarray(region_codes, dtype=np.int64))
+            # The title codes are dense, so they spread the titles evenly over the shards.
+            counts = self._map_ranges(_count_shards, directory, {'title_codes': len(title_codes)})
+            bounds = self._partition(directory, {'title_codes': (['title_codes', 'region_codes'], np.array(counts['title_codes']))})
+            for column, dtype in [('nunique', np.int64), ('last', np.int64), ('present', bool)]:
+                _create(directory, column, dtype, (len(title_ids),))
+            self._run(_resolve_shard, directory, bounds['title_codes'], len(title_ids), len(region_values))
+            nunique, last, present = [np.load(_path(directory, column)) for column in ['nunique', 'last', 'present']]
+        # The results are indexed by title code, so the titles are in the order of resolve_regions.
+        present = np.flatnonzero(present)
+        return pd.DataFrame(
+            {'nunique': nunique[present], 'last': pd.Index(region_values).take(last[present]).to_numpy()},
+            index=pd.Index(title_ids.take(present), name='titleId'),
+        ).sort_index()
+
+    def match_original_titles(self, titles, is_original):
+        # Rows are sharded by the hash of their title rather than by titleId: a translation matches the
+        # original titles of any title, so only the rows with equal titles have to share a shard.
+        if len(titles) == 0:
+            return match_original_titles(titles, is_original)
+        with tempfile.TemporaryDirectory(dir=self.directory) as directory:
+            _save_strings(directory, 'titles', titles)
+            np.save(_path(directory, 'is_original'), np.asarray(is_original, dtype=bool))
+            _create(directory, 'title_hashes', np.uint64, (len(titles),))
+            futures = [self.executor.submit(_hash_titles, directory, start, end, self.shards) for start, end in self._ranges(len(titles))]
+            counts = np.array([future.result() for future in futures])
+            bounds = self._partition(directory, {'title_hashes': (['is_original'], counts)})
+            _create(directory, 'matches', bool, (len(titles),))
+            self._run(_match_shard, directory, bounds['title_hashes'])
+            return np.load(_path(directory, 'matches'))
+
+    def join_titles(self, region, tables, macro_data):
+        indexes = {'region': region.index, **{f'table_{number}': table.index for number, table in enumerate(tables)}}
+        with tempfile.TemporaryDirectory(dir=self.directory) as directory:
+            for name, index in indexes.items():
+                _save_strings(directory, name + '_ids', index)
+                _create(directory, name + '_keys', np.int32, (len(index),))
+            parsed = self._map_ranges(_parse_keys, directory, {name: len(index) for name, index in indexes.items()})
+            if not keys_identify_ids([widths for ranges in parsed.values() for _, widths in ranges]):
+                return None
+            counts = {name: np.array([range_counts for range_counts, _ in ranges]) for name, ranges in parsed.items()}
+            bounds = self._partition(directory, {name + '_keys': ([name + '_keys'], counts[name]) for name in indexes})
+
+            # Columns with a numpy layout are gathered by the workers, the others by take_rows in the parent.
+            layouts, gathers = [], []
+            for number, table in enumerate(tables):
+                layouts.append({})
+                gathers.append([])
+                for column_number, column in enumerate(table.columns):
+                    parts = _column_parts(table[column].values)
+                    if parts is None:
+                        continue
+                    layouts[number][column] = list(parts)
+                    for part, (values, fill) in parts.items():
+                        name = f'table_{number}_{column_number}_{part}'
+                        np.save(_path(directory, name), values)
+                        _create(directory, 'joined_' + name, values.dtype, (len(region),))
+                        gathers[number].append((name, fill))
+            _create(directory, 'positions', np.int64, (len(tables), len(region)))
+            if not all(self._run(_join_shard, directory, bounds, len(tables), gathers)):
+                return None
+
+            positions = np.load(_path(directory, 'positions'))
+            joined = [region]
+            for number, table in enumerate(tables):
+                missing = positions[number] < 0
+                columns = {}
+                for column_number, column in enumerate(table.columns):
+                    values = table[column].values
+                    if column in layouts[number]:
+                        parts = {
+                            part: np.load(_path(directory, f'joined_table_{number}_{column_number}_{part}'))
+                            for part in layouts[number][column]
+                        }
+                        columns[column] = _from_parts(values, parts, missing)
+                    else:
+                        columns[column] = pd.api.extensions.take(values, positions[number], allow_fill=True)
+                joined.append(pd.DataFrame(columns, index=region.index))
+        joined.append(take_macro_rows(region, macro_data))
+        return fill_genre_masks(pd.concat(joined, axis=1))
@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+# Bump whenever the layout of the stored table changes so old stores are rebuilt.
+STORE_VERSION = 4
+
+
+def _paths(directory):
+    return os.path.join(directory, 'years'), os.path.join(directory, 'titles.json')
+
+
+def _year_path(directory, year):
+    return os.path.join(_paths(directory)[0], f'{year}.feather')
+
+
+def _store_schema(titles):
+    # Schema shared by the files of all years. Dictionary indices are int32, so a year rewritten
+    # with more categories still has the schema of the other years.
+    schema = pa.Schema.from_pandas(titles.reset_index(), preserve_index=False)
+    for i, field in enumerate(schema):
+        if pa.types.is_dictionary(field.type):
+            schema = schema.set(i, field.with_type(pa.dictionary(pa.int32(), field.type.value_type)))
+    return schema
+
+
+def _schema_path(directory):
+    return os.path.join(_paths(directory)[0], 'schema.feather')
+
+
+def _read_schema(directory):
+    return feather.read_table(_schema_path(directory), memory_map=True).schema
+
+
+def _write_years(titles, directory, schema):
+    # One uncompressed Feather file per startYear, which can be memory-mapped. Returns the number of rows of every year.
+    titles = titles.sort_values('startYear', kind='stable')
+    years, starts = np.unique(titles['startYear'].to_numpy(dtype=np.int64), return_index=True)
+    for year, start, end in zip(years, starts, list(starts[1:]) + [len(titles)]):
+        table = pa.Table.from_pandas(titles.iloc[start:end].reset_index(), schema=schema, preserve_index=False)
+        feather.write_feather(table, _year_path(directory, year) + '.tmp', compression='uncompressed')
+        os.replace(_year_path(directory, year) + '.tmp', _year_path(directory, year))
+    return dict(zip(years.tolist(), np.diff(np.append(starts, len(titles))).tolist()))
+
+
+def _write_metadata(directory, metadata, index_name, rows):
+    # The json file next to the years, with the first row of every year in the store and the given metadata.
+    years = sorted(year for year in rows if rows[year] > 0)
+    metadata = dict(metadata)
+    metadata['version'] = STORE_VERSION
+    metadata['index_name'] = index_name
+    metadata['years'] = years
+    metadata['offsets'] = np.cumsum([0] + [rows[year] for year in years]).tolist()
+    metadata_path = _paths(directory)[1]
+    with open(metadata_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    os.replace(metadata_path + '.tmp', metadata_path)
+
+
+def save_year_store(titles, directory, metadata):
+    # Joined titles partitioned by startYear, next to a json file with the years and the given metadata.
+    shutil.rmtree(_paths(directory)[0], ignore_errors=True)
+    schema = _store_schema(titles)
+    os.makedirs(_paths(directory)[0])
+    # An empty table with the schema, so a store of no titles still has its columns.
+    feather.write_feather(schema.empty_table(), _schema_path(directory), compression='uncompressed')
+    rows = _write_years(titles, directory, schema)
+    _write_metadata(directory, metadata, titles.index.name, rows)
+
+
+def update_year_store(directory, titles, removed, metadata):
+    # Replaces the stored rows of the titleIds in removed with titles. Only the files of the years
+    # that lose or gain rows are read and written again.
+    store = YearStore(directory)
+    index_name = store.metadata['index_name']
+    keys = store.table.select([index_name, 'startYear'])
+    is_removed = pc.is_in(keys[index_name], value_set=pa.array(np.asarray(removed, dtype=object), type=pa.string()))
+    years = set(pc.unique(keys.filter(is_removed)['startYear']).to_pylist())
+    years.update(titles['startYear'].dropna().astype(int).unique().tolist())
+    rows = dict(zip(store.years.tolist(), np.diff(store.offsets).tolist()))
+    parts = []
+    for year in sorted(years):
+        if year in rows:
+            start, end = store.rows(year, year)
+            part = store.table.slice(start, end - start).to_pandas().set_index(index_name)
+            parts.append(part.loc[~part.index.isin(removed)])
+        parts.append(titles.loc[titles['startYear'] == year])
+        rows[year] = 0
+    del store, keys
+    if parts:
+        rows.update(_write_years(pd.concat(parts), directory, _read_schema(directory)))
+    for year in years:
+        if rows[year] == 0 and os.path.exists(_year_path(directory, year)):
+            os.remove(_year_path(directory, year))
+    _write_metadata(directory, metadata, index_name, rows)
+
+
+def read_store_metadata(directory):
+    try:
+        with open(_paths(directory)[1], 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if metadata.get('version') != STORE_VERSION:
+        return None
+    return metadata
+
+
+class YearStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.metadata = read_store_metadata(directory)
+        if self.metadata is None:
+            raise FileNotFoundError(f'No titles store in {directory}')
+        self.years = np.array(self.metadata['years'], dtype=np.int64)
+        # The memory-mapped files of all years, in order of startYear, as a single table.
+        self.table = pa.concat_tables([feather.read_table(_schema_path(directory), memory_map=True)] + [
+            feather.read_table(_year_path(directory, year), memory_map=True) for year in self.years
+        ])
+        self.offsets = np.array(self.metadata['offsets'], dtype=np.int64)
+        self._frame = None
+
+    def __len__(self):
+        return self.table.num_rows
+
+    def rows(self, start_year, end_year):
+        # First and last row (exclusive) of the titles with start_year <= startYear <= end_year.
+        first = np.searchsorted(self.years, start_year, side='left')
+        last = np.searchsorted(self.years, end_year, side='right')
+        return int(self.offsets[first]), int(self.offsets[max(last, first)])
+
+    def to_pandas(self):
+        return self.table.to_pandas().set_index(self.metadata['index_name'])
+
+    def frame(self):
+        # The whole table as a DataFrame, converted once and kept for processes that query many ranges.
+        if self._frame is None:
+            self._frame = self.to_pandas()
+        return self._frame
+
+    def frame_slice(self, start_year, end_year):
+        # Rows of the years of frame(), a view without any conversion.
+        start, end = self.rows(start_year, end_year)
+        return self.frame().iloc[start:end]
+
+    def slice(self, start_year, end_year):
+        start, end = self.rows(start_year, end_year)
+        return self.table.slice(start, end - start).to_pandas().set_index(self.metadata['index_name'])
+
+
+def _snapshot_path(directory, name):
+    return os.path.join(directory, 'snapshot', name + '.parquet')
+
+
+def save_snapshot(directory, frames):
+    # Frames describing the inputs a store was built from, used to refresh it incrementally.
+    os.makedirs(os.path.join(directory, 'snapshot'), exist_ok=True)
+    for name, frame in frames.items():
+        frame.to_parquet(_snapshot_path(directory, name) + '.tmp')
+        os.replace(_snapshot_path(directory, name) + '.tmp', _snapshot_path(directory, name))
+
+
+def load_snapshot(directory, names):
+    try:
+        return {name: pd.read_parquet(_snapshot_path(directory, name)) for name in names}
+    except (OSError, ValueError):
+        return None
@@ -1,8 +1,94 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
 import unittest
 from unittest.mock import patch
 import pandas as pd
 import numpy as np
-from data import Data, get_data
+from compression import open_input
+from data import Data, find_regions, get_data, join_titles, key_hashes, mapping, mapping_countries, match_original_titles, SCHEMAS
+from ranking import top_k_means
+from store import load_snapshot
+from instrumentation import StageRecorder
+from server import AnalysisServer
+from sharding import ShardPool
+import report
+from report import Report
+from genres import GENRES, explode_genres, genre_mask, genre_masks, has_genres
+from trends import ALL_GENRES, trend, trend_cube
+from benchmark import compare, compress_dataset, generate_dataset, measure, run_benchmark
+
+def legacy_region(titles):
+    # Reference implementation of region resolution with groupby.agg(['nunique', 'last']) over all columns.
+    titles = titles.copy()
+    titles_og = titles.loc[titles.isOriginalTitle == 1, 'title']
+    titles['region'] = titles['region'].replace(mapping)
+    titles = titles.loc[~titles.reset_index().duplicated(keep='first').to_numpy()]
+    titles_og = titles.loc[
+        titles.title.isin(titles_og) &
+        (titles.isOriginalTitle == 0) &
+        (~titles.region.isna())
+    ].groupby('titleId').agg(['nunique', 'last'])
+    lost_ids = titles_og.loc[titles_og['region']['nunique'] != 1].index
+    region = titles_og.loc[titles_og['region']['nunique'] == 1, 'region'][['last']]
+    region.columns = ['region']
+    return region, titles.loc[titles.index.isin(lost_ids)]
+
+def legacy_macro(gdp, population, code_mapping, year):
+    # Reference implementation of get_macro for a single year, with the row-wise regionName apply.
+    gdp = gdp[['Country Code', 'Country Name', year]]
+    gdp.columns = ['country_id', 'regionName', 'gdp']
+    population = population[['Country Code', 'Country Name', year]]
+    population.columns = ['country_id', 'regionName', 'population']
+    macro_data = gdp.set_index('country_id').join(population.set_index('country_id')[['population']])
+    code_mapping.loc['WLD'] = 'WD'
+    macro_data = macro_data.join(code_mapping[['alpha-2']])
+    macro_data['alpha-2'] = macro_data['alpha-2'].replace(mapping)
+    macro_data['regionName'] = macro_data.apply(lambda row: mapping_countries.get(row['alpha-2'], row['regionName']), axis=1)
+    macro_data = macro_data.groupby('alpha-2').agg({'gdp': 'sum', 'population': 'sum', 'regionName': 'first'})
+    macro_data['gdp_pc'] = macro_data['gdp'] / macro_data['population']
+    return macro_data
+
+def write_imdb_files(directory):
+    # Small title.akas, title.ratings and title.basics dumps in the IMDb TSV format.
+    paths = {name: os.path.join(directory, name + '.tsv') for name in ['title.akas', 'title.ratings', 'title.basics']}
+    with open(paths['title.akas'], 'w') as f:
+        f.write('titleId\tordering\ttitle\tregion\tlanguage\ttypes\tattributes\tisOriginalTitle\n')
+        for title_id, title, region, is_original in [
+            ('tt1', 'Title1', '\\N', 1), ('tt1', 'Title1', 'GB', 0), ('tt1', 'Title1', 'AU', 0),
+            ('tt2', 'Title2', '\\N', 1), ('tt2', 'Title2', 'PL', 0),
+            ('tt3', 'Title3', '\\N', 1), ('tt3', 'Title3', 'PL', 0), ('tt3', 'Title3', 'DE', 0),
+            ('tt4', 'Title4', '\\N', 1), ('tt4', 'Title4', 'PL', 0),
+            ('tt5', 'Title5', '\\N', 1), ('tt5', 'Title5', 'US', 0),
+        ]:
+            f.write(f'{title_id}\t1\t{title}\t{region}\t\\N\t\\N\t\\N\t{is_original}\n')
+    with open(paths['title.ratings'], 'w') as f:
+        f.write('tconst\taverageRating\tnumVotes\n')
+        f.write('tt1\t8.0\t20000\ntt2\t7.0\t500\ntt3\t6.0\t2000\ntt4\t5.5\t15000\ntt5\t9.1\t30000\n')
+    with open(paths['title.basics'], 'w') as f:
+        f.write('tconst\ttitleType\tprimaryTitle\toriginalTitle\tisAdult\tstartYear\tendYear\truntimeMinutes\tgenres\n')
+        for title_id, title_type, year, genres in [
+            ('tt1', 'movie', '2000', 'Comedy,Drama'), ('tt2', 'movie', '2010', 'Comedy'), ('tt3', 'short', '2020', '\\N'),
+            ('tt4', 'movie', '2010', 'Drama'), ('tt5', 'movie', '\\N', 'Action'),
+        ]:
+            f.write(f'{title_id}\t{title_type}\tT\tT\t0\t{year}\t\\N\t90\t{genres}\n')
+    return paths
+
+def build_data(paths, start_year=1900, end_year=2022, **kwargs):
+    # The World Bank files of the repository unless paths has its own, e.g. from generate_dataset.
+    return Data(
+        paths['title.akas'],
+        paths.get('gdp', 'World_Bank_Data/gdp.csv'),
+        paths.get('population', 'World_Bank_Data/population.csv'),
+        paths.get('code_mapping', 'World_Bank_Data/code_mapping.csv'),
+        paths['title.ratings'],
+        paths['title.basics'],
+        start_year,
+        end_year,
+        **kwargs,
+    )
 
 class TestDataMethods(unittest.TestCase):
 
@@ -34,13 +120,62 @@ class TestDataMethods(unittest.TestCase):
         self.assertIsInstance(result, pd.DataFrame)
         self.assertFalse(result.empty)
 
+    def test_get_data_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'title.ratings.tsv')
+            with open(path, 'w') as f:
+                f.write('tconst\taverageRating\tnumVotes\ntt1\t8.0\t1000\ntt2\t7.0\t500\n')
+            cache_dir = os.path.join(tmp, 'cache')
+            first = get_data(path, 'imdb', 'tconst', cache_dir=cache_dir)
+
+            with patch('pandas.read_csv', wraps=pd.read_csv) as mock_read_csv:
+                second = get_data(path, 'imdb', 'tconst', cache_dir=cache_dir)
+                mock_read_csv.assert_not_called()
+            pd.testing.assert_frame_equal(first, second)
+
+            os.utime(path, ns=(0, 0))
+            with patch('pandas.read_csv', wraps=pd.read_csv) as mock_read_csv:
+                get_data(path, 'imdb', 'tconst', cache_dir=cache_dir)
+                mock_read_csv.assert_not_called()
+
+            with open(path, 'a') as f:
+                f.write('tt3\t6.0\t2000\n')
+            third = get_data(path, 'imdb', 'tconst', cache_dir=cache_dir)
+            self.assertEqual(len(third), 3)
+
+    def test_get_data_schema(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'title.akas.tsv')
+            with open(path, 'w') as f:
+                f.write('titleId\tordering\ttitle\tregion\tlanguage\ttypes\tattributes\tisOriginalTitle\n')
+                f.write('tt1\t1\t"Quoted\t\\N\t\\N\toriginal\t\\N\t1\n')
+                f.write('tt1\t2\tNA\tNA\ten\t\\N\t\\N\t0\n')
+            result = get_data(path, 'imdb', 'titleId', schema=SCHEMAS['title.akas'])
+
+        self.assertEqual(result.columns.tolist(), ['title', 'region', 'language', 'isOriginalTitle'])
+        self.assertEqual(result['title'].tolist(), ['"Quoted', 'NA'])
+        self.assertIsInstance(result['region'].dtype, pd.CategoricalDtype)
+        self.assertTrue(pd.isna(result['region'].iloc[0]))
+        self.assertEqual(result['region'].iloc[1], 'NA')
+        self.assertEqual(str(result['isOriginalTitle'].dtype), 'Int8')
+
+    def test_ratings_schema(self):
+        # Ratings keep their decimal value through the aggregates, e.g. 9.1 and not 9.1000003815.
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = write_imdb_files(tmp)
+            for engine in ['pandas', 'arrow']:
+                ratings = get_data(paths['title.ratings'], 'imdb', 'tconst', schema=SCHEMAS['title.ratings'], engine=engine)
+                self.assertEqual(str(ratings['averageRating'].dtype), 'Float64')
+                self.assertEqual(ratings['averageRating'].max(), 9.1)
+                self.assertEqual(ratings.loc[['tt1', 'tt5'], 'averageRating'].mean(), (8.0 + 9.1) / 2)
+
     @patch('pandas.read_csv')
     def test_get_region(self, mock_read_csv):
         mock_read_csv.side_effect = [
             pd.DataFrame({
                 'titleId': ['1', '1', '1', '2', '2', '2', '3', '3', '3'],
                 'isOriginalTitle': [1, 0, 0, 1, 0, 0, 1, 0, 0],
-                'region': ['\\N', 'GB', 'AU', '\\N', 'PL', 'DE', '\\N', 'PL', 'DE'],
+                'region': [np.nan, 'GB', 'AU', np.nan, 'PL', 'DE', np.nan, 'PL', 'DE'],
                 'title': ['Title1', 'Title1', 'Title1', 'Title2', 'Title2_2', 'Title2', 'Title3', 'Title3', 'Title3']
             }).set_index('titleId')
         ]
@@ -51,6 +186,74 @@ class TestDataMethods(unittest.TestCase):
         self.assertEqual(self.data.region['region'].tolist(), ['EN', 'DE', 'WD'])
 
 
+    def test_get_region_chunked(self):
+        rows = [
+            ('1', 'Title1', '\\N', 1), ('1', 'Title1', 'GB', 0), ('1', 'Title1', 'AU', 0),
+            ('2', 'Title2', '\\N', 1), ('2', 'Title2_2', 'PL', 0), ('2', 'Title2', 'DE', 0), ('2', 'Title2', 'DE', 0),
+            ('3', 'Title3', '\\N', 1), ('3', 'Title3', 'PL', 0), ('3', 'Title3', 'DE', 0), ('3', 'Title3', 'PL', 0),
+            ('4', 'Title1', '\\N', 1), ('4', 'Title1', 'FR', 0), ('4', 'Title4', 'IT', 0),
+            ('5', 'Title5', 'US', 0), ('5', 'Title3', 'US', 0),
+        ]
+        # The rows of every title are together in the first file. In the second, the rows of title 3, which
+        # has no single region, are split, so they are gathered by a third pass over title.akas.
+        interleaved = rows[8:10] + rows[:10] + rows[10:]
+        for rows, passes in [(rows, 2), (interleaved, 3)]:
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'title.akas.tsv')
+                with open(path, 'w') as f:
+                    f.write('titleId\tordering\ttitle\tregion\tlanguage\ttypes\tattributes\tisOriginalTitle\n')
+                    for title_id, title, region, is_original in rows:
+                        f.write(f'{title_id}\t1\t{title}\t{region}\t\\N\t\\N\t\\N\t{is_original}\n')
+
+                expected = Data(path, '', '', '', '', '', 1900, 2022)
+                expected.get_region()
+                for chunksize in [1, 2, 5, 100]:
+                    chunked = Data(path, '', '', '', '', '', 1900, 2022, chunksize=chunksize)
+                    with patch.object(chunked, '_read_akas_chunks', wraps=chunked._read_akas_chunks) as read_akas_chunks:
+                        chunked.get_region()
+                    self.assertEqual(read_akas_chunks.call_count, passes)
+                    pd.testing.assert_frame_equal(chunked.region.astype(object), expected.region.astype(object))
+                    pd.testing.assert_frame_equal(chunked.lost_region, expected.lost_region, check_categorical=False)
+                    for counter in ['akas_length', 'unique_movies_length', 'found_region_length', 'lost_region_count']:
+                        self.assertEqual(getattr(chunked, counter), getattr(expected, counter))
+
+    def test_get_region_chunked_compactions(self):
+        # Every title adds distinct pairs, so a fixed threshold would compact on almost every chunk.
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'title.akas.tsv')
+            with open(path, 'w') as f:
+                f.write('titleId\tordering\ttitle\tregion\tlanguage\ttypes\tattributes\tisOriginalTitle\n')
+                for i in range(2_000):
+                    f.write(f'tt{i}\t1\tTitle{i}\t\\N\t\\N\t\\N\t\\N\t1\n')
+                    f.write(f'tt{i}\t2\tTitle{i}\t{["PL", "DE"][i % 2]}\t\\N\t\\N\t\\N\t0\n')
+
+            expected = Data(path, '', '', '', '', '', 1900, 2022)
+            expected.get_region()
+            chunked = Data(path, '', '', '', '', '', 1900, 2022, chunksize=10)
+            chunked.get_region()
+            pd.testing.assert_frame_equal(chunked.region.astype(object), expected.region.astype(object))
+            self.assertLessEqual(chunked.pair_compactions, int(np.log2(2_000 / 40)) + 2)
+
+    def test_get_region_matches_groupby(self):
+        rng = np.random.default_rng(0)
+        size = 5_000
+        names = np.array([f'Title{i}' for i in range(300)] + [np.nan], dtype=object)
+        titles = pd.DataFrame({
+            'titleId': [f'tt{i:04d}' for i in rng.integers(0, 800, size)],
+            'title': names[rng.integers(0, len(names), size)],
+            'region': np.array(list(mapping) + ['PL', 'FR', 'JP', np.nan], dtype=object)[rng.integers(0, len(mapping) + 4, size)],
+            'language': np.array(['en', 'pl', np.nan], dtype=object)[rng.integers(0, 3, size)],
+            'isOriginalTitle': rng.integers(0, 2, size),
+        }).set_index('titleId')
+        expected_region, expected_lost = legacy_region(titles)
+
+        with patch('pandas.read_csv', return_value=titles.copy()):
+            self.data.include_world = False
+            self.data.get_region()
+        pd.testing.assert_frame_equal(self.data.region.astype(object), expected_region.astype(object))
+        pd.testing.assert_frame_equal(self.data.lost_region.astype(object), expected_lost.astype(object))
+        self.assertEqual(self.data.lost_region_count, len(expected_lost.index.unique()))
+
     @patch('pandas.read_csv')
     def test_get_macro(self, mock_read_csv):
         mock_read_csv.side_effect = [
@@ -82,7 +285,7 @@ class TestDataMethods(unittest.TestCase):
             pd.DataFrame({
                 'titleId': ['1', '1', '1', '2', '2', '2', '3', '3', '3'],
                 'isOriginalTitle': [1, 0, 0, 1, 0, 0, 1, 0, 0],
-                'region': ['\\N', 'GB', 'AU', '\\N', 'PL', 'DE', '\\N', 'PL', 'DE'],
+                'region': [np.nan, 'GB', 'AU', np.nan, 'PL', 'DE', np.nan, 'PL', 'DE'],
                 'title': ['Title1', 'Title1', 'Title1', 'Title2', 'Title2_2', 'Title2', 'Title3', 'Title3', 'Title3']
             }).set_index('titleId'),
             pd.DataFrame({
@@ -118,5 +321,558 @@ class TestDataMethods(unittest.TestCase):
         self.assertEqual(self.data.titles.regionName.tolist(), ['International English', 'International German', 'World'])
         self.assertEqual(len(self.data.titles), 3)
 
+    def test_join_data_numpy_backend(self):
+        akas = pd.DataFrame({
+            'titleId': ['tt1', 'tt1', 'tt2', 'tt2', 'tt3', 'tt3', 'tt12', 'tt12'],
+            'isOriginalTitle': [1, 0, 1, 0, 1, 0, 1, 0],
+            'region': [np.nan, 'GB', np.nan, 'PL', np.nan, 'FR', np.nan, 'DE'],
+            'title': ['Title1', 'Title1', 'Title2', 'Title2', 'Title3', 'Title3', 'Title12', 'Title12'],
+        }).set_index('titleId')
+        macro_data = pd.DataFrame({
+            'gdp': [1500.0, 60.0, 120.0],
+            'population': [360.0, 40.0, 80.0],
+            'regionName': ['International English', 'Poland', 'International German'],
+        }, index=pd.Index(['EN', 'PL', 'DE'], name='alpha-2'))
+        macro_data['gdp_pc'] = macro_data['gdp'] / macro_data['population']
+        ratings = pd.DataFrame({
+            'tconst': ['tt12', 'tt2', 'tt1'],
+            'averageRating': pd.array([6.0, 7.0, 8.0], dtype='Float64'),
+            'numVotes': pd.array([2000, 500, 1000], dtype='Int32'),
+        }).set_index('tconst')
+        basics = pd.DataFrame({
+            'tconst': ['tt1', 'tt2', 'tt3', 'tt12'],
+            'titleType': pd.Categorical(['movie', 'movie', 'short', 'movie']),
+            'startYear': pd.array([2000, 2010, 2020, None], dtype='Int32'),
+        }).set_index('tconst')
+
+        results = []
+        for backend in ['pandas', 'numpy']:
+            self.data.join_backend = backend
+            self.data.start_year, self.data.end_year = 1900, 2022
+            self.data.macro_data = macro_data
+            with patch('pandas.read_csv', side_effect=[akas.copy(), ratings, basics]):
+                self.data.get_region()
+                results.append(self.data.join_data())
+        pd.testing.assert_frame_equal(results[0], results[1])
+        self.assertEqual(results[1].index.tolist(), ['tt1', 'tt2', 'tt3'])
+        self.assertTrue(pd.isna(results[1].loc['tt3', 'numVotes']))
+        self.assertTrue(pd.isna(results[1].loc['tt3', 'gdp']))
+
+    def test_join_title_id_formats(self):
+        macro_data = pd.DataFrame({'gdp': [60.0], 'regionName': ['Poland']}, index=pd.Index(['PL'], name='alpha-2'))
+        self.data.macro_data = macro_data
+        cases = [
+            # Zero-padded IMDb ids and a longer one, joined on their keys.
+            (['tt0000001', 'tt0000012', 'tt10000000'], ['tt10000000', 'tt0000001', 'tt0000012'], True),
+            # 'tt1' and 'tt01' have the same key.
+            (['tt1', 'tt01'], ['tt01', 'tt2'], False),
+            (['tt1', 'tt2'], ['tt0000001', 'tt2'], False),
+            # Ids which are not 'tt' followed by digits, or too long for a 32-bit key.
+            (['tt1', 'title2'], ['tt1', 'title2'], False),
+            (['tt1', 'tt'], ['tt1', 'tt'], False),
+            (['tt1', 'tt12345678901'], ['tt1', 'tt12345678901'], False),
+            # A key repeated within a table.
+            (['tt1', 'tt2'], ['tt1', 'tt1'], False),
+        ]
+        with tempfile.TemporaryDirectory() as directory, ShardPool(2, directory=directory) as shard_pool:
+            for region_ids, table_ids, joined_on_keys in cases:
+                region = pd.DataFrame({'region': ['PL'] * len(region_ids)}, index=pd.Index(region_ids, name='titleId'))
+                ratings = pd.DataFrame(
+                    {'numVotes': pd.array(range(len(table_ids)), dtype='Int32')}, index=pd.Index(table_ids, name='tconst'),
+                )
+                basics = pd.DataFrame({'startYear': pd.array([2000] * len(table_ids), dtype='Int32')}, index=ratings.index)
+                self.data.join_backend, self.data.shard_pool = 'pandas', None
+                expected = self.data._join(region, ratings, basics)
+                for join in [join_titles, shard_pool.join_titles]:
+                    titles = join(region, [ratings, basics], macro_data)
+                    self.assertEqual(titles is not None, joined_on_keys)
+                    if titles is not None:
+                        pd.testing.assert_frame_equal(titles, expected)
+                for backend, pool in [('numpy', None), ('pandas', shard_pool)]:
+                    self.data.join_backend, self.data.shard_pool = backend, pool
+                    pd.testing.assert_frame_equal(self.data._join(region, ratings, basics), expected)
+        self.data.shard_pool = None
+
+    def test_get_macro_panel(self):
+        data = build_data({'title.akas': '', 'title.ratings': '', 'title.basics': ''})
+        gdp = get_data(data.gdp_path, 'world_bank')
+        population = get_data(data.population_path, 'world_bank')
+        code_mapping = pd.read_csv(data.mapping_path, index_col='alpha-3')
+
+        for year in ['2022', '1990', '1960']:
+            expected = legacy_macro(gdp, population, code_mapping.copy(), year)
+            pd.testing.assert_frame_equal(data.get_macro(year), expected)
+        self.assertEqual(sorted(data.load_times), ['code_mapping', 'gdp', 'population'])
+
+        with patch('data.get_data') as mock_get_data:
+            self.assertEqual(data.get_macro('1850'), -1)
+            panel = data.get_macro_panel(years=[2000, 2010])
+            mock_get_data.assert_not_called()
+        self.assertEqual(sorted(panel.index.get_level_values('year').unique()), [2000, 2010])
+
+    def test_year_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = write_imdb_files(tmp)
+            store_dir = os.path.join(tmp, 'titles_store')
+            built = build_data(paths)
+            built.get_macro('2022')
+            built.build_year_store(store_dir)
+
+            loaded = build_data(paths)
+            self.assertTrue(loaded.load_year_store(store_dir, 2022))
+            self.assertFalse(build_data(paths, world=False).load_year_store(store_dir, 2022))
+            self.assertFalse(build_data(paths).load_year_store(store_dir, 2010))
+            for start_year, end_year in [(1900, 2022), (2000, 2009), (2010, 2010), (2021, 2030)]:
+                expected = build_data(paths)
+                expected.start_year, expected.end_year = start_year, end_year
+                expected = expected.join_data().sort_values('startYear', kind='stable')
+                pd.testing.assert_frame_equal(loaded.select_years(start_year, end_year), expected)
+                pd.testing.assert_frame_equal(loaded.year_store.frame_slice(start_year, end_year), expected)
+            self.assertEqual(loaded.titles_length, built.titles_length)
+
+    def test_refresh(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = write_imdb_files(tmp)
+            store_dir = os.path.join(tmp, 'titles_store')
+            with open(paths['title.akas'], 'a') as f:
+                f.write('tt7\t1\tTitle6\tDE\t\\N\t\\N\t\\N\t0\n')
+            with open(paths['title.basics'], 'a') as f:
+                f.write('tt7\tmovie\tT\tT\t0\t2016\t\\N\t90\tDrama\n')
+            built = build_data(paths, snapshot=True)
+            self.assertFalse(built.refresh(store_dir, 2022))
+            built.get_region()
+            built.get_macro('2022')
+            built.build_year_store(store_dir)
+
+            # The snapshot hashes come from the frames the build loads anyway, title.akas is streamed once.
+            chunked_dir = os.path.join(tmp, 'chunked_store')
+            chunked = build_data(paths, chunksize=2, snapshot=True)
+            chunked.get_region()
+            chunked.get_macro('2022')
+            with patch.object(Data, '_load', autospec=True, side_effect=Data._load) as load:
+                chunked.build_year_store(chunked_dir)
+            self.assertEqual([call.args[1] for call in load.call_args_list], ['title.ratings', 'title.basics'])
+            for name, frame in load_snapshot(store_dir, ['original_titles', 'akas_hashes']).items():
+                pd.testing.assert_frame_equal(load_snapshot(chunked_dir, [name])[name], frame)
+
+            with open(paths['title.akas'], 'a') as f:
+                # tt2 gets a second region, tt6 is new and its original title matches the unchanged tt7.
+                f.write('tt2\t1\tTitle2\tFR\t\\N\t\\N\t\\N\t0\n')
+                f.write('tt6\t1\tTitle6\t\\N\t\\N\t\\N\t\\N\t1\n')
+                f.write('tt6\t1\tTitle6\tES\t\\N\t\\N\t\\N\t0\n')
+            with open(paths['title.ratings']) as f:
+                ratings = f.read().replace('tt4\t5.5\t15000', 'tt4\t5.0\t16000')
+            with open(paths['title.ratings'], 'w') as f:
+                f.write(ratings + 'tt6\t6.5\t12000\n')
+            with open(paths['title.basics'], 'a') as f:
+                f.write('tt6\tmovie\tT\tT\t0\t2015\t\\N\t90\tDrama\n')
+
+            year_files = {year: os.stat(os.path.join(store_dir, 'years', f'{year}.feather')).st_ino for year in [2000, 2010, 2020]}
+            refreshed = build_data(paths)
+            self.assertTrue(refreshed.refresh(store_dir, 2022))
+            self.assertTrue(refreshed.check_consistency())
+            self.assertEqual(sorted(refreshed.year_store.to_pandas().index), ['tt1', 'tt2', 'tt3', 'tt4', 'tt6', 'tt7'])
+            # Only the years of tt2, tt4, tt6 and tt7 are written again.
+            for year, inode in year_files.items():
+                self.assertEqual(os.stat(os.path.join(store_dir, 'years', f'{year}.feather')).st_ino == inode, year != 2010)
+            chunked = build_data(paths, chunksize=2)
+            self.assertTrue(chunked.refresh(chunked_dir, 2022))
+            self.assertTrue(chunked.check_consistency())
+            self.assertTrue(build_data(paths).load_year_store(store_dir, 2022))
+            self.assertFalse(build_data(paths, world=False).refresh(store_dir, 2022))
+
+    def test_load_all(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = write_imdb_files(tmp)
+            expected = build_data(paths)
+            expected.join_data()
+            for pool in ['thread', 'process']:
+                prefetched = build_data(paths, prefetch=True, workers=3, prefetch_pool=pool)
+                prefetched.join_data()
+                pd.testing.assert_frame_equal(prefetched.titles, expected.titles)
+                self.assertEqual(
+                    sorted(prefetched.load_times),
+                    ['code_mapping', 'gdp', 'population', 'title.akas', 'title.basics', 'title.ratings'],
+                )
+
+    def test_sharded_matches_serial(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_dataset(directory, 2_000, seed=3)
+            with ShardPool(3, directory=directory) as shard_pool:
+                for chunksize, engine in [(None, 'pandas'), (1_000, 'pandas'), (None, 'arrow')]:
+                    results = []
+                    for pool in [None, shard_pool]:
+                        data = build_data(paths, 1800, 2100, chunksize=chunksize, shard_pool=pool, engine=engine)
+                        data.join_data()
+                        results.append(data)
+                    serial, sharded = results
+                    pd.testing.assert_frame_equal(sharded.region_stats, serial.region_stats)
+                    pd.testing.assert_frame_equal(sharded.lost_region, serial.lost_region)
+                    pd.testing.assert_frame_equal(sharded.titles, serial.titles)
+                # Shards without any title of the inputs.
+                titles = pd.DataFrame({'title': ['A', 'A'], 'isOriginalTitle': [1, 0], 'region': pd.Categorical([None, 'PL'])}, index=pd.Index(['tt3', 'tt3'], name='titleId'))
+                pd.testing.assert_frame_equal(
+                    find_regions(titles, resolve=shard_pool.resolve_regions)[0], find_regions(titles)[0],
+                )
+                is_original = np.array([True, False, True, False, False, False, False])
+                for dtype in [object, 'string[pyarrow]']:
+                    titles = pd.Series(['A', 'B', None, 'A', 'C', None, 'B'], dtype=dtype)
+                    np.testing.assert_array_equal(
+                        shard_pool.match_original_titles(titles, is_original), match_original_titles(titles, is_original),
+                    )
+
+    def test_arrow_engine_matches_pandas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_dataset(directory, 2_000, seed=4)
+            for chunksize in [None, 1_000]:
+                results = []
+                for engine in ['pandas', 'arrow']:
+                    data = build_data(paths, 1800, 2100, chunksize=chunksize, engine=engine)
+                    data.join_data()
+                    results.append(data)
+                expected, arrow = results
+                self.assertEqual(arrow.lost_region['title'].dtype, pd.StringDtype('pyarrow'))
+                self.assertEqual(arrow.titles.index.dtype, pd.StringDtype('pyarrow'))
+                pd.testing.assert_frame_equal(arrow.region_stats, expected.region_stats, check_index_type=False)
+                pd.testing.assert_frame_equal(arrow.lost_region, expected.lost_region, check_dtype=False, check_index_type=False)
+                pd.testing.assert_frame_equal(arrow.titles, expected.titles, check_dtype=False, check_index_type=False)
+                np.testing.assert_array_equal(key_hashes(arrow.titles)['hash'], key_hashes(expected.titles)['hash'])
+
+            # Cached tables of the arrow engine are read back into Arrow memory.
+            cache_dir = os.path.join(directory, 'cache')
+            for _ in range(2):
+                akas = get_data(paths['title.akas'], 'imdb', 'titleId', cache_dir=cache_dir, schema=SCHEMAS['title.akas'], engine='arrow')
+                self.assertEqual(akas['title'].dtype, pd.StringDtype('pyarrow'))
+                self.assertEqual(akas.index.dtype, pd.StringDtype('pyarrow'))
+
+    def test_compressed_inputs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_dataset(directory, 2_000, seed=5)
+            compressed = compress_dataset(paths)
+            self.assertTrue(compressed['title.akas'].endswith('.tsv.gz'))
+            for engine in ['pandas', 'arrow']:
+                expected = get_data(paths['title.akas'], 'imdb', 'titleId', schema=SCHEMAS['title.akas'], engine=engine)
+                pd.testing.assert_frame_equal(
+                    get_data(compressed['title.akas'], 'imdb', 'titleId', schema=SCHEMAS['title.akas'], engine=engine), expected,
+                )
+                # Small blocks and queue, so the reader waits on the decompressing thread.
+                with patch('data.open_input', lambda path: open_input(path, block_size=4096, queue_size=2)):
+                    chunks = list(get_data(
+                        compressed['title.akas'], 'imdb', 'titleId', schema=SCHEMAS['title.akas'], chunksize=1_000, engine=engine,
+                    ))
+                self.assertEqual([len(chunk) for chunk in chunks[:-1]], [1_000] * (len(chunks) - 1))
+                chunks = pd.concat(chunks).astype({'region': 'category', 'language': 'category'})
+                pd.testing.assert_frame_equal(chunks, expected, check_dtype=False)
+
+            data = build_data(compressed, 1800, 2100, chunksize=1_000)
+            data.join_data()
+            expected = build_data(paths, 1800, 2100, chunksize=1_000)
+            expected.join_data()
+            pd.testing.assert_frame_equal(data.titles, expected.titles)
+
+            # Abandoned chunked reads and missing files stop the decompressing thread.
+            threads = threading.active_count()
+            chunks = get_data(compressed['title.akas'], 'imdb', 'titleId', schema=SCHEMAS['title.akas'], chunksize=100)
+            next(chunks)
+            chunks.close()
+            self.assertIsNone(get_data(os.path.join(directory, 'missing.tsv.gz'), 'imdb'))
+            self.assertEqual(threading.active_count(), threads)
+
+    def test_stage_recorder(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_imdb_files(directory)
+            profile_dir = os.path.join(directory, 'profiles')
+            data = build_data(paths, recorder=StageRecorder(profile_dir))
+            data.get_region()
+            data.get_macro()
+            data.join_data()
+
+            stages = {stage['stage']: stage for stage in data.recorder.stages}
+            self.assertEqual(
+                sorted(stages),
+                sorted(['load title.akas', 'get_region', 'load gdp', 'load population', 'load code_mapping',
+                        'get_macro', 'load title.ratings', 'load title.basics', 'join_data']),
+            )
+            self.assertEqual(stages['get_region']['rows_in'], data.akas_length)
+            self.assertEqual(stages['get_region']['rows_out'], len(data.region))
+            self.assertEqual(stages['join_data']['rows_out'], len(data.titles))
+            self.assertEqual(stages['load title.akas']['depth'], 1)
+            # Only top-level stages are profiled, one file each.
+            self.assertTrue(os.path.exists(stages['get_region']['profile']))
+            self.assertNotIn('profile', stages['load title.akas'])
+            self.assertEqual(len(os.listdir(profile_dir)), 3)
+
+            manifest = data.recorder.write_manifest(os.path.join(directory, 'manifest.json'), counters={'akas_length': data.akas_length})
+            self.assertEqual(len(manifest['stages']), 9)
+            self.assertTrue(all(stage['seconds'] >= 0 for stage in manifest['stages']))
+
+    @unittest.skipUnless(os.path.exists('/proc/self/clear_refs'), 'peak RSS is only reset on Linux')
+    def test_stage_recorder_memory(self):
+        recorder = StageRecorder()
+        with recorder.stage('peak'):
+            np.ones(2 ** 24).sum()
+        with recorder.stage('hold'):
+            held = np.ones(2 ** 24)
+        del held
+        with recorder.stage('small'):
+            with recorder.stage('nested'):
+                np.ones(10).sum()
+        with recorder.stage('parent'):
+            with recorder.stage('nested_peak'):
+                np.ones(2 ** 24).sum()
+            with recorder.stage('nested_after'):
+                np.ones(10).sum()
+        stages = {stage['stage']: stage for stage in recorder.stages}
+        # 128MB arrays, the peak and the held memory are attributed to their own stage only.
+        self.assertGreater(stages['peak']['peak_rss_mb'] - stages['peak']['rss_start_mb'], 100)
+        self.assertLess(stages['peak']['rss_delta_mb'], 100)
+        self.assertGreater(stages['hold']['rss_delta_mb'], 100)
+        self.assertLess(stages['small']['peak_rss_mb'] - stages['small']['rss_start_mb'], 100)
+        self.assertLess(stages['nested']['peak_rss_mb'] - stages['nested']['rss_start_mb'], 100)
+        # The peak of a nested stage is its own and also counts towards its parent, even though a later nested
+        # stage resets it.
+        self.assertGreater(stages['nested_peak']['peak_rss_mb'] - stages['nested_peak']['rss_start_mb'], 100)
+        self.assertLess(stages['nested_after']['peak_rss_mb'] - stages['nested_after']['rss_start_mb'], 100)
+        self.assertGreaterEqual(stages['parent']['peak_rss_mb'], stages['nested_peak']['peak_rss_mb'])
+
+class TestReport(unittest.TestCase):
+
+    def test_outputs_share_artifacts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_imdb_files(directory)
+            data = build_data(paths)
+            data.join_data()
+            results = Report(data)
+            cwd = os.getcwd()
+            os.chdir(directory)
+            try:
+                with patch('report.best_movies_by_region', wraps=report.best_movies_by_region) as best_movies_by_region:
+                    for output_format in ['html', 'json', 'csv']:
+                        results.save(output_format)
+                    self.assertEqual(best_movies_by_region.call_count, 1)
+                self.assertIn('Top 5 movies from each region', open('results.html').read())
+                with open('results.json') as f:
+                    output = json.load(f)
+                self.assertEqual(output['counters']['akas_length'], data.akas_length)
+                self.assertEqual(
+                    sorted(os.listdir('results')),
+                    sorted(name + '.csv' for name in output['tables']),
+                )
+                ranking = pd.read_csv(os.path.join('results', 'impact_ranking.csv'), index_col=0)
+                pd.testing.assert_frame_equal(ranking, results['ranking'], check_names=False)
+                self.assertEqual(results.save_plots(), None)
+                self.assertTrue(os.path.exists('polish_movies_analysis.png'))
+            finally:
+                os.chdir(cwd)
+
+class TestServer(unittest.TestCase):
+
+    def test_queries(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_imdb_files(directory)
+            data = build_data(paths)
+            data.get_region()
+            data.get_macro()
+            data.build_year_store(os.path.join(directory, 'store'))
+            expected = data.select_years(1990, 2022)
+            server = AnalysisServer(data, workers=2)
+
+            async def requests():
+                responses = [await server.respond('GET', '/rankings?start_year=1990&end_year=2022') for _ in range(2)]
+                responses.append(await server.respond('GET', '/regions'))
+                responses.append(await server.respond('GET', '/rankings?k=3'))
+                responses.append(await server.respond('GET', '/unknown'))
+                responses.append(await server.respond('GET', '/trends?start_year=1990'))
+                responses.append(await server.respond('GET', '/trends?region=Poland&genres=Comedy'))
+
+                # Over a socket, as the dashboards query it.
+                tcp_server = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+                reader, writer = await asyncio.open_connection(*tcp_server.sockets[0].getsockname()[:2])
+                writer.write(b'GET /health HTTP/1.1\r\nHost: localhost\r\n\r\n')
+                response = await reader.read()
+                writer.close()
+                tcp_server.close()
+                return responses, response
+
+            responses, response = asyncio.run(requests())
+            server.executor.shutdown()
+
+            status, body = responses[0]
+            self.assertEqual(status, 200)
+            self.assertEqual(body['version'], data.data_version())
+            best_movies = expected.loc[lambda x: (x['numVotes'] > 10_000) & (x['titleType'] == 'movie')]
+            self.assertEqual(sorted(body['result']), sorted(best_movies['regionName'].dropna().unique()))
+            self.assertEqual(responses[1], responses[0])
+            self.assertEqual(server.cache.hits, 1)
+            regions = data.year_store.to_pandas()['regionName'].value_counts()
+            self.assertEqual({name: region['titles'] for name, region in responses[2][1]['result'].items()}, regions.to_dict())
+            self.assertEqual(responses[3][0], 400)
+            self.assertEqual(responses[4][0], 404)
+            self.assertEqual(responses[5][0], 200)
+            self.assertEqual(set(responses[5][1]['result']), {'regions', 'genres'})
+            self.assertIn('Poland', responses[5][1]['result']['regions'])
+            self.assertEqual(responses[6][0], 400)
+            self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+            self.assertEqual(json.loads(response.split(b'\r\n\r\n', 1)[1])['titles'], len(data.year_store))
+
+            # A second server in the same process builds its cubes from its own titles.
+            with open(paths['title.ratings']) as f:
+                ratings = f.read().replace('tt4\t5.5\t15000', 'tt4\t5.5\t100')
+            with open(paths['title.ratings'], 'w') as f:
+                f.write(ratings)
+            changed = build_data(paths)
+            changed.get_region()
+            changed.get_macro()
+            changed.build_year_store(os.path.join(directory, 'changed_store'))
+            server = AnalysisServer(changed, workers=1)
+            status, body = asyncio.run(server.respond('GET', '/trends?start_year=1990'))
+            server.executor.shutdown()
+            self.assertNotIn('Poland', body['result']['regions'])
+
+class TestRanking(unittest.TestCase):
+
+    def test_top_k_means(self):
+        rng = np.random.default_rng(0)
+        size = 2_000
+        titles = pd.DataFrame({
+            'regionName': np.array(['Poland', 'France', 'World', np.nan], dtype=object)[rng.integers(0, 4, size)],
+            'startYear': pd.array(rng.integers(1990, 2000, size), dtype='Int32'),
+            'averageRating': pd.array(rng.integers(10, 100, size) / 10, dtype='Float64'),
+        })
+        titles.loc[rng.random(size) < 0.1, 'averageRating'] = pd.NA
+
+        for by in ['regionName', ['regionName', 'startYear']]:
+            result = top_k_means(titles, by, 'averageRating', [1, 5, 20])
+            for k in [1, 5, 20]:
+                expected = titles.groupby(by)['averageRating'].apply(lambda x: x.astype(float).nlargest(k).mean())
+                pd.testing.assert_series_equal(result[k], expected, check_names=False, check_index_type=False)
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_generate_and_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_dataset(directory, 500, seed=1, block_size=200)
+            akas = get_data(paths['title.akas'], 'imdb', schema=SCHEMAS['title.akas'])
+            self.assertEqual(akas['titleId'].nunique(), 500)
+            self.assertEqual(akas.drop_duplicates()['isOriginalTitle'].sum(), 500)
+            mtime = os.stat(paths['title.akas']).st_mtime_ns
+            self.assertEqual(generate_dataset(directory, 500, seed=1), paths)
+            self.assertEqual(os.stat(paths['title.akas']).st_mtime_ns, mtime)
+
+            run = run_benchmark(paths, memory=True)
+            self.assertEqual(
+                [stage['stage'] for stage in run['stages']],
+                ['get_region', 'get_macro', 'join_data', 'task_1', 'task_2', 'task_3'],
+            )
+            self.assertGreater(run['rows']['titles'], 0)
+            for stage in run['stages']:
+                self.assertEqual({'peak_rss_mb', 'workers_peak_rss_mb', 'arrow_allocated_mb'} - set(stage), set())
+            if os.path.exists('/proc/self/clear_refs'):
+                self.assertTrue(all(stage['peak_rss_mb'] >= stage['arrow_allocated_mb'] for stage in run['stages']))
+            with ShardPool(2) as shard_pool:
+                shard_pool.resolve_regions(['tt1'], [0], ['PL'], [0])
+                _, record = measure('resolve', shard_pool.resolve_regions, ['tt1'], [0], ['PL'], [0])
+            if os.path.exists('/proc/self/clear_refs'):
+                # The workers of the pool are running, so their memory is part of the stage.
+                self.assertGreater(record['workers_peak_rss_mb'], 0)
+
+            run['titles'] = 500
+            slower = {'runs': [dict(run, stages=[dict(stage, seconds=stage['seconds'] * 2 + 1) for stage in run['stages']])]}
+            self.assertEqual(compare({'runs': [run]}, {'runs': [run]}, 0.2), [])
+            self.assertEqual(len(compare({'runs': [run]}, slower, 0.2)), 6)
+
+    def test_vote_distribution(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = generate_dataset(directory, 20_000, seed=2)
+            ratings = get_data(paths['title.ratings'], 'imdb', 'tconst', schema=SCHEMAS['title.ratings'])
+            basics = get_data(paths['title.basics'], 'imdb', 'tconst', schema=SCHEMAS['title.basics'])
+            movies = ratings.join(basics['titleType']).loc[lambda x: x['titleType'] == 'movie']
+            # About 0.1% of the titles pass the filter of task 1, so the task timings are not measured on empty frames.
+            self.assertTrue(0.0005 < (movies['numVotes'] > 10_000).sum() / 20_000 < 0.002)
+
+class TestGenres(unittest.TestCase):
+
+    def test_genre_masks(self):
+        genres = pd.Series(['Comedy', 'Drama,Romance', 'Action,Comedy,Drama', np.nan, 'Comedy,Unknown', 'Sci-Fi,Western'])
+        masks = genre_masks(genres)
+        self.assertEqual(masks.dtype, np.uint32)
+        for genre in GENRES:
+            expected = genres.str.split(',').apply(lambda x: isinstance(x, list) and genre in x).to_numpy()
+            np.testing.assert_array_equal(has_genres(masks, [genre]), expected)
+        np.testing.assert_array_equal(has_genres(masks, ['Comedy', 'Drama']), [False, False, True, False, False, False])
+        np.testing.assert_array_equal(has_genres(masks, any_of=['Romance', 'Western']), [False, True, False, False, False, True])
+        np.testing.assert_array_equal(has_genres(masks, ['Drama'], ['Action', 'Romance']), [False, True, True, False, False, False])
+        np.testing.assert_array_equal(genre_masks(genres.astype('category')), masks)
+        self.assertEqual(genre_mask(['Action', 'Adult']), 3)
+        with self.assertRaises(ValueError):
+            genre_mask('Unknown')
+
+        rows, genre_indexes = explode_genres(masks)
+        expected = [
+            (row, GENRES.index(genre))
+            for row, value in genres.dropna().items() for genre in value.split(',') if genre in GENRES
+        ]
+        self.assertEqual(sorted(zip(rows.tolist(), genre_indexes.tolist())), sorted(expected))
+
+    def test_join_data_genre_mask(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_imdb_files(directory)
+            titles = build_data(paths).join_data()
+            self.assertEqual(titles['genreMask'].dtype, np.uint32)
+            np.testing.assert_array_equal(titles['genreMask'].to_numpy(), genre_masks(titles['genres']))
+
+    def test_genre_mask_without_basics(self):
+        # tt9 has a region but no title.basics row, so the left join leaves its mask missing.
+        with tempfile.TemporaryDirectory() as directory:
+            paths = write_imdb_files(directory)
+            with open(paths['title.akas'], 'a') as f:
+                f.write('tt9\t1\tTitle9\t\\N\t\\N\t\\N\t\\N\t1\n')
+                f.write('tt9\t2\tTitle9\tPL\t\\N\t\\N\t\\N\t0\n')
+            with ShardPool(2, directory=directory) as shard_pool:
+                for options in [{}, {'join_backend': 'numpy'}, {'engine': 'arrow'}, {'shard_pool': shard_pool}]:
+                    data = build_data(paths, **options)
+                    data.get_region()
+                    data.get_macro()
+                    # join_data drops titles without a startYear, so check the join itself.
+                    titles = data._join(data.region, data._load('title.ratings'), data._load('title.basics'))
+                    self.assertEqual(titles['genreMask'].dtype, np.uint32)
+                    self.assertEqual(titles.loc['tt9', 'genreMask'], 0)
+                    self.assertFalse(has_genres(titles['genreMask'], any_of=['Comedy', 'Drama'])[titles.index == 'tt9'].any())
+
+class TestTrends(unittest.TestCase):
+
+    def test_trend_cube(self):
+        rng = np.random.default_rng(0)
+        size = 3_000
+        genres = np.array(['Comedy', 'Drama', 'Comedy,Drama', 'Action,Comedy,Drama', 'Horror', np.nan], dtype=object)
+        titles = pd.DataFrame({
+            'regionName': np.array(['Poland', 'France', 'World', np.nan], dtype=object)[rng.integers(0, 4, size)],
+            'titleType': pd.Categorical(np.array(['movie', 'short'])[rng.integers(0, 2, size)]),
+            'startYear': pd.array(rng.integers(1990, 2000, size), dtype='Int32'),
+            'numVotes': pd.array(rng.integers(0, 6_000, size), dtype='Int32'),
+            'averageRating': pd.array(rng.integers(10, 100, size) / 10, dtype='Float64'),
+            'genres': pd.Categorical(genres[rng.integers(0, len(genres), size)]),
+        })
+        titles.loc[rng.random(size) < 0.05, 'averageRating'] = pd.NA
+
+        cube = trend_cube(titles, k=5)
+        with_masks = titles.assign(genreMask=genre_masks(titles['genres']))
+        pd.testing.assert_frame_equal(trend_cube(with_masks.drop(columns='genres'), k=5), cube)
+        movies = titles.loc[(titles['titleType'] == 'movie') & (titles['numVotes'] > 3_000)]
+        for region in ['Poland', 'France', 'World']:
+            for genre in [ALL_GENRES, 'Comedy', 'Drama', 'Action', 'Horror']:
+                selected = movies.loc[movies['regionName'] == region]
+                if genre != ALL_GENRES:
+                    selected = selected.loc[selected['genres'].str.split(',').apply(lambda x: isinstance(x, list) and genre in x)]
+                ratings = selected.groupby('startYear')['averageRating']
+                pd.testing.assert_series_equal(
+                    trend(cube, region, genre, 'mean'), ratings.mean().dropna(), check_names=False, check_index_type=False,
+                )
+                expected = ratings.apply(lambda x: x.astype(float).nlargest(5).mean()).dropna()
+                pd.testing.assert_series_equal(
+                    trend(cube, region, genre, 'top_5'), expected, check_names=False, check_index_type=False,
+                )
+        self.assertEqual(len(trend(cube, 'Nowhere')), 0)
+
 if __name__ == '__main__':
     unittest.main()
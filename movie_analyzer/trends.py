@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+from genres import GENRES, explode_genres, genre_masks
+from ranking import top_k_means
+
+# Genre of the cube rows that aggregate all titles of a region and year, whatever their genres.
+ALL_GENRES = 'All'
+CUBE_KEYS = ['regionName', 'genre', 'startYear']
+
+
+def trend_cube(titles, k=5, min_votes=3_000, title_type='movie'):
+    # Per-year statistics of the ratings of every (region, genre) at once, over the titles of title_type
+    # with more than min_votes votes. The cube is indexed by (regionName, genre, startYear), where genre
+    # ALL_GENRES covers all titles, and has the mean and count of the ratings and the mean of the k best.
+    columns = ['regionName', 'startYear', 'genreMask' if 'genreMask' in titles.columns else 'genres', 'averageRating']
+    movies = titles.loc[
+        lambda x: (x['titleType'] == title_type) & (x['numVotes'] > min_votes) & x['regionName'].notna(),
+        columns,
+    ]
+    masks = movies['genreMask'].to_numpy() if 'genreMask' in movies.columns else genre_masks(movies['genres'])
+    positions, genres = explode_genres(masks)
+    # Every title is counted once under ALL_GENRES and once under each of its genres.
+    rows = np.concatenate([np.arange(len(movies)), positions])
+    genre_codes = np.concatenate([np.zeros(len(movies), dtype=np.int64), genres + 1])
+    genre_names = pd.Index([ALL_GENRES] + GENRES, dtype=object)
+    pairs = pd.DataFrame({
+        'regionName': movies['regionName'].array[rows],
+        'genre': pd.Categorical.from_codes(genre_codes, genre_names),
+        'startYear': movies['startYear'].array[rows],
+        'averageRating': movies['averageRating'].array[rows],
+    })
+
+    cube = pairs.groupby(CUBE_KEYS, observed=True, sort=True)['averageRating'].agg(['mean', 'count'])
+    top = top_k_means(pairs, CUBE_KEYS, 'averageRating', [k])[k].rename(f'top_{k}')
+    return cube.join(top)
+
+
+def trend(cube, region, genre=ALL_GENRES, column='mean'):
+    # Yearly series of one (region, genre) slice of the cube.
+    try:
+        series = cube.xs((region, genre), level=['regionName', 'genre'])[column]
+    except KeyError:
+        series = cube[column].iloc[:0].droplevel(['regionName', 'genre'])
+    return series.dropna()
@@ -13,8 +13,11 @@ setup(
     package_dir={'': 'NPD_project'},
     include_package_data=True,
     install_requires=[
-        'numpy', 'pandas', 'matplotlib', 'argparse', 'IPython'
+        'numpy', 'pandas', 'pyarrow', 'matplotlib', 'argparse', 'IPython'
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'movie_analyzer=movie_analyzer.main:main',